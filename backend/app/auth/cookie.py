@@ -1,26 +1,70 @@
+import time
+from collections import OrderedDict
 from typing import Annotated
 
 import jwt
 from fastapi import Depends, HTTPException, Request, Response, status
-from jwt.exceptions import DecodeError
+from jwt.exceptions import InvalidTokenError
 
+from ..config import get_settings
 from ..utils.user_info import UserInfo
 
 _COOKIE_NAME = "feedapp_session_token"
 
 
+class VerifiedTokenCache:
+    """
+    Remembers recently verified tokens of this process,
+    so the signature of a token is not verified again on every request.
+
+    Key ideas:
+    - Bounded in size, the least recently used token is evicted first
+    - A token is only remembered until it expires
+    - Tokens can't be revoked, so there is nothing to invalidate
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+        # User, issue time and expiry time (unix seconds), in least recently used order
+        self.entries: OrderedDict[str, tuple[UserInfo, float, float]] = OrderedDict()
+
+    def get(self, token: str) -> tuple[UserInfo, float] | None:
+        """Get the user and issue time of a verified token, if it has not expired"""
+        entry = self.entries.get(token)
+        if entry is None:
+            return None
+
+        user, issued_at, expires_at = entry
+        if time.time() >= expires_at:
+            del self.entries[token]
+            return None
+
+        self.entries.move_to_end(token)
+        return user, issued_at
+
+    def put(self, token: str, user: UserInfo, issued_at: float, expires_at: float):
+        self.entries[token] = (user, issued_at, expires_at)
+        self.entries.move_to_end(token)
+        if len(self.entries) > self.max_size:
+            _ = self.entries.popitem(last=False)
+
+
 def set_auth_cookie(user_info: UserInfo, response: Response):
     """
     Create a JWT and store it in a cookie
     """
-    token = jwt.encode(user_info.__dict__, "secret", algorithm="HS256")
+    lifetime = get_settings().AUTH_TOKEN_LIFETIME_S
+    issued_at = int(time.time())
+    claims = {**user_info.__dict__, "iat": issued_at, "exp": issued_at + lifetime}
+    token = jwt.encode(claims, "secret", algorithm="HS256")
     response.set_cookie(
         key=_COOKIE_NAME,
         value=token,
         httponly=True,
         secure=False,  # TODO: set this to True (breaks the TestClient)
         samesite="strict",
-        max_age=3600,  # 1 hour
+        max_age=lifetime,
     )
 
 
@@ -42,20 +86,36 @@ def get_current_user_optional(request: Request, response: Response) -> UserInfo
     if not token_str:
         return None
 
-    # TODO: Validate properly
-    try:
-        token = jwt.decode(token_str, "secret", algorithms=["HS256"])
-    except DecodeError:
-        raise
-
-    user = UserInfo(
-        id=token["id"],
-        username=token["username"],
-        email=token["email"],
+    verified_tokens: VerifiedTokenCache = request.app.state.verified_tokens
+    verified = verified_tokens.get(token_str)
+    if verified is None:
+        try:
+            token = jwt.decode(
+                token_str,
+                "secret",
+                algorithms=["HS256"],
+                options={"require": ["iat", "exp"]},
+            )
+        except InvalidTokenError:
+            # E.g. expired, the user has to log in again
+            return None
+
+        user = UserInfo(
+            id=token["id"],
+            username=token["username"],
+            email=token["email"],
+        )
+        verified_tokens.put(token_str, user, token["iat"], token["exp"])
+        verified = (user, token["iat"])
+
+    # Renew the token once it is past a part of its lifetime, not on every request
+    user, issued_at = verified
+    settings = get_settings()
+    renew_at = (
+        issued_at + settings.AUTH_TOKEN_LIFETIME_S * settings.AUTH_TOKEN_RENEW_AFTER
     )
-
-    # Renew the token
-    set_auth_cookie(user, response)
+    if time.time() >= renew_at:
+        set_auth_cookie(user, response)
 
     return user
 
@@ -0,0 +1,94 @@
+import asyncio
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Annotated
+
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from fastapi import Depends, HTTPException, Request, status
+
+from app.config import Settings
+
+
+class PasswordHashingPool:
+    """
+    Hashes and verifies passwords with Argon2 on a bounded thread pool,
+    so the event loop (and every SSE stream on it) keeps running meanwhile.
+
+    Key ideas:
+    - argon2-cffi releases the GIL while hashing, so the threads run in parallel
+    - At most max_workers hashes run at once, and at most max_queued wait for a thread
+    - When the queue is full, requests fail fast with a 503 instead of piling up
+    """
+
+    def __init__(self, hasher: PasswordHasher, max_workers: int, max_queued: int):
+        self.hasher = hasher
+        self.max_pending = max_workers + max_queued
+        self.pending = 0
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="argon2"
+        )
+
+    async def hash(self, password: str) -> str:
+        return await self._run(partial(self.hasher.hash, password))
+
+    async def verify(self, password_hash: str, password: str) -> bool:
+        return await self._run(partial(self._verify, password_hash, password))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _verify(self, password_hash: str, password: str) -> bool:
+        try:
+            return self.hasher.verify(password_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+
+    async def _run[T](self, fn: Callable[[], T]) -> T:
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many logins at once, try again in a moment",
+                headers={"Retry-After": "1"},
+            )
+
+        # Counted until the job itself is done, not the request waiting for it,
+        # as a cancelled request leaves a job running (or queued if it can't be removed)
+        self.pending += 1
+        loop = asyncio.get_running_loop()
+        job = self.executor.submit(fn)
+        job.add_done_callback(lambda _: self._call_soon(loop, self._job_done))
+        return await asyncio.wrap_future(job)
+
+    def _job_done(self):
+        self.pending -= 1
+
+    @staticmethod
+    def _call_soon(loop: asyncio.AbstractEventLoop, callback: Callable[[], None]):
+        # Jobs finish on the executor's threads, possibly after the loop is closed
+        try:
+            _ = loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass
+
+
+def create_password_hashing_pool(settings: Settings) -> PasswordHashingPool:
+    hasher = PasswordHasher(
+        time_cost=settings.ARGON2_TIME_COST,
+        memory_cost=settings.ARGON2_MEMORY_COST_KIB,
+        parallelism=settings.ARGON2_PARALLELISM,
+    )
+    return PasswordHashingPool(
+        hasher,
+        max_workers=settings.PASSWORD_HASHING_WORKERS,
+        max_queued=settings.PASSWORD_HASHING_MAX_QUEUED,
+    )
+
+
+def _get_password_hashing_pool(request: Request) -> PasswordHashingPool:
+    return request.app.state.password_hashing_pool
+
+
+# Injectable dependency for our routes
+PasswordHashing = Annotated[PasswordHashingPool, Depends(_get_password_hashing_pool)]
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Annotated
+
+from fastapi import Depends, Request
+from sqlalchemy.ext.asyncio import AsyncConnection
+from valkey.asyncio import ConnectionPool, Valkey
+
+from app.db.sqlc import auth as auth_queries
+from app.db.sqlc.models import Permission
+from app.db.valkey import listen_to_topic
+
+PERMISSION_INVALIDATION_TOPIC = "permission-invalidations"
+
+# (user_id, poll_id, permission)
+_Key = tuple[int | None, int | None, Permission]
+
+
+class PermissionDecisionCache:
+    """
+    Caches permission decisions of can_user_do_at for this worker process.
+
+    Key ideas:
+    - Bounded in size, the least recently used decision is evicted first
+    - Decisions expire after a TTL, or earlier if a relevant grant period
+        starts or ends before that
+    - Grant mutations publish invalidations on a Valkey channel that every worker
+        listens to. They must be published after the mutation is committed,
+        otherwise another worker could cache the old decision again in between
+    - The cache is cleared whenever the listener (re)subscribes,
+        as invalidations might have been missed while it was not subscribed
+    """
+
+    def __init__(self, valkey_pool: ConnectionPool, max_size: int, ttl: float):
+        self.valkey_pool = valkey_pool
+        self.max_size = max_size
+        self.ttl = ttl
+
+        # Decision and its expiry (monotonic clock), in least recently used order
+        self.entries: OrderedDict[_Key, tuple[bool, float]] = OrderedDict()
+        # Bumped on every invalidation, to detect it during a lookup in the database
+        self.generation = 0
+
+        self.listener_task: asyncio.Task[None] | None = None
+
+    def start(self):
+        self.listener_task = asyncio.create_task(
+            listen_to_topic(
+                self.valkey_pool,
+                PERMISSION_INVALIDATION_TOPIC,
+                on_message=self._on_invalidation,
+                on_subscribed=self.invalidate,
+            )
+        )
+
+    async def stop(self):
+        if self.listener_task is not None:
+            _ = self.listener_task.cancel()
+            _ = await asyncio.gather(self.listener_task, return_exceptions=True)
+            self.listener_task = None
+
+    async def can_user_do(
+        self,
+        conn: AsyncConnection,
+        user_id: int | None,
+        poll_id: int | None,
+        permission: Permission,
+    ) -> bool:
+        """Check if a user has a permission on a poll right now"""
+        key = (user_id, poll_id, permission)
+        entry = self.entries.get(key)
+        if entry is not None:
+            allowed, expires_at = entry
+            if time.monotonic() < expires_at:
+                self.entries.move_to_end(key)
+                return allowed
+            del self.entries[key]
+
+        generation = self.generation
+        a = auth_queries.AsyncQuerier(conn)
+        decision = await a.can_user_do_until(
+            user_id=user_id, poll_id=poll_id, permission=permission
+        )
+        allowed = decision is not None and bool(decision.allowed)
+
+        ttl = self.ttl
+        if decision is not None and decision.valid_until is not None:
+            valid_for = decision.valid_until - datetime.now(tz=timezone.utc)
+            ttl = min(ttl, valid_for.total_seconds())
+
+        # Don't cache a decision that might have been invalidated in the meantime
+        if generation == self.generation and ttl > 0:
+            self.entries[key] = (allowed, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                _ = self.entries.popitem(last=False)
+
+        return allowed
+
+    def invalidate(self, poll_id: int | None = None, user_id: int | None = None):
+        """
+        Forget the decisions about a poll or a user, e.g. a moderator.
+        Forgets everything if neither is given.
+        """
+        self.generation += 1
+        if poll_id is None and user_id is None:
+            self.entries.clear()
+            return
+
+        stale = [
+            key
+            for key in self.entries
+            if (poll_id is not None and key[1] == poll_id)
+            or (user_id is not None and key[0] == user_id)
+        ]
+        for key in stale:
+            del self.entries[key]
+
+    async def publish_invalidation(
+        self, valkey: Valkey, poll_id: int | None = None, user_id: int | None = None
+    ):
+        """
+        Invalidate decisions in every worker, after changing grants.
+        The change must already be committed.
+        """
+        self.invalidate(poll_id=poll_id, user_id=user_id)
+        message = json.dumps({"poll_id": poll_id, "user_id": user_id})
+        _ = await valkey.publish(PERMISSION_INVALIDATION_TOPIC, message)
+
+    def _on_invalidation(self, message: bytes):
+        invalidation = json.loads(message)
+        self.invalidate(
+            poll_id=invalidation["poll_id"], user_id=invalidation["user_id"]
+        )
+
+
+def _get_permission_cache(request: Request) -> PermissionDecisionCache:
+    return request.app.state.permission_cache
+
+
+# Injectable dependency for our routes
+PermissionCache = Annotated[PermissionDecisionCache, Depends(_get_permission_cache)]
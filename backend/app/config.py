@@ -1,4 +1,5 @@
 from functools import lru_cache
+from typing import Literal
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -25,8 +26,43 @@ class Settings(BaseSettings):
     VALKEY_CONN_STR: str
     KAFKA_BOOTSTRAP_SERVERS: str
 
+    # See PRODUCER_PROFILES in app/db/kafka.py, single settings can be overridden
+    KAFKA_PRODUCER_PROFILE: Literal["latency", "throughput"] = "latency"
+    KAFKA_PRODUCER_LINGER_MS: int | None = None
+    KAFKA_PRODUCER_MAX_BATCH_SIZE: int | None = None
+    KAFKA_PRODUCER_COMPRESSION: Literal["none", "gzip"] | None = None
+    KAFKA_PRODUCER_ACKS: Literal["0", "1", "all"] | None = None
+
+    CONSUMER_MAX_BATCH_SIZE: int = 500
+    CONSUMER_LANES: int = 4  # Should not exceed DB_MAX_POOL_SIZE
+    POLL_UPDATE_INTERVAL_MS: int = 100
+
+    PERMISSION_CACHE_MAX_SIZE: int = 10_000
+    PERMISSION_CACHE_TTL_S: float = 60
+
+    POLL_METADATA_CACHE_MAX_SIZE: int = 10_000
+    POLL_METADATA_CACHE_TTL_S: float = 3600
+
+    POLL_DOCUMENT_CACHE_MAX_SIZE: int = 10_000
+    POLL_DOCUMENT_CACHE_TTL_S: float = 3600
+
+    AUTH_TOKEN_LIFETIME_S: int = 3600
+    AUTH_TOKEN_RENEW_AFTER: float = 0.5  # Part of the lifetime
+    AUTH_TOKEN_CACHE_MAX_SIZE: int = 10_000
+
+    # Only used for new hashes, existing ones keep their parameters
+    ARGON2_TIME_COST: int = 3
+    ARGON2_MEMORY_COST_KIB: int = 65536
+    ARGON2_PARALLELISM: int = 4
+    PASSWORD_HASHING_WORKERS: int = 2
+    PASSWORD_HASHING_MAX_QUEUED: int = 32
+
     SSE_MAX_CONNECTIONS_PER_USER: int = 5
     SSE_MAX_CONNECTIONS_TOTAL: int = 1000
+    SSE_HEARTBEAT_INTERVAL_S: float = 15.0
+
+    # How often every process writes its metrics to Valkey, for /metrics to sum them
+    METRICS_WRITE_INTERVAL_S: float = 5.0
 
     @property
     def database_url(self) -> str:
@@ -1,53 +1,154 @@
+import argparse
 import asyncio
+import multiprocessing
+import os
 import signal
-from datetime import datetime, timezone
+import time
+from functools import partial
+from multiprocessing.process import BaseProcess
 from types import FrameType
 
 import uvloop
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener, TopicPartition
 from sqlalchemy.ext.asyncio import AsyncConnection
 from valkey.asyncio import ConnectionPool, Valkey
 
 from app.config import Settings
 from app.db.db import create_db_engine
-from app.db.kafka import VoteEvent, create_kafka_consumer
+from app.db.kafka import (
+    VOTE_EVENT_TOPIC,
+    VoteEvent,
+    create_kafka_consumer,
+    get_vote_event_partition_count,
+)
 from app.db.sqlc import vote as vote_queries
-from app.db.valkey import publish_poll_update
-from app.utils.vote_counter import ensure_valkey_vote_table, vote_table_key
+from app.utils.consumer_lanes import ConsumerLanes
+from app.utils.metrics import keep_writing_metrics
+from app.utils.poll_metadata import TieredPollMetadataCache
+from app.utils.poll_publisher import PollUpdatePublisher
+from app.utils.vote_counter import apply_vote_deltas, ensure_valkey_vote_table
 
 shutdown_event = asyncio.Event()
 
+_WORKER_RESTART_DELAY_S = 5
+_WORKER_SHUTDOWN_TIMEOUT_S = 30
 
-async def process_vote(
-    poll_id: int,
-    ve: VoteEvent,
-    _recv_time: datetime,
+
+async def process_votes(
+    votes: list[tuple[int, VoteEvent]],
     conn: AsyncConnection,
     valkey: Valkey,
+    poll_metadata: TieredPollMetadataCache,
+    publisher: PollUpdatePublisher | None,
 ):
-    await ensure_valkey_vote_table(poll_id, conn, valkey)
+    """
+    Process a batch of (poll_id, VoteEvent) pairs in a single transaction.
+    Votes must be given in the order they were received.
+    """
+    # Votes on deleted polls, or on options of another poll, can never be stored
+    option_ids: dict[int, set[int]] = {}
+    for poll_id in {poll_id for poll_id, _ in votes}:
+        metadata = await poll_metadata.get(conn, valkey, poll_id)
+        option_ids[poll_id] = set(metadata.option_ids) if metadata else set()
+
+    # Only the most recent vote of a user on a poll matters
+    latest_votes: dict[tuple[int, int], int] = {}
+    dropped = 0
+    for poll_id, ve in votes:
+        if ve.poll_option_id not in option_ids[poll_id]:
+            dropped += 1
+            continue
+        latest_votes[(poll_id, ve.user_id)] = ve.poll_option_id
+
+    if dropped:
+        print(f"Dropped {dropped} vote(s) on deleted polls or invalid options")
+    if not latest_votes:
+        return
+
+    poll_ids = {poll_id for poll_id, _ in latest_votes}
+    for poll_id in poll_ids:
+        await ensure_valkey_vote_table(poll_id, conn, valkey)
 
     q = vote_queries.AsyncQuerier(conn)
-    # Ensure new vote (and potential deletion of old) is written without conflicts to DB
-    deleted_vote_option_id = await q.delete_user_vote_on_poll(
-        poll_id=poll_id, user_id=ve.user_id
-    )
-    await q.submit_vote(user_id=ve.user_id, vote_option_id=ve.poll_option_id)
-    await conn.commit()
+    # Insert new votes, replacing previous ones, and get what they replaced
+    upserted_votes = [
+        x
+        async for x in q.upsert_votes(
+            user_ids=[user_id for _, user_id in latest_votes],
+            poll_ids=[poll_id for poll_id, _ in latest_votes],
+            vote_option_ids=list(latest_votes.values()),
+        )
+    ]
 
-    # Atomically increment (and potentially decrement) vote counts
-    pipe = valkey.pipeline()
-    if deleted_vote_option_id is not None:
-        pipe.hincrby(vote_table_key(poll_id), str(deleted_vote_option_id), -1)
-    pipe.hincrby(vote_table_key(poll_id), str(ve.poll_option_id), 1)
-    _ = await pipe.execute()
-
-    # Get the updated vote counts and publish to Redis pub/sub
-    vote_counts: dict[int, int] = await valkey.hgetall(vote_table_key(poll_id))
-    vote_counts_list = [
-        vote_queries.GetVoteCountsRow(vote_option_id=k, vote_count=v)
-        for k, v in vote_counts.items()
+    # Increment (and potentially decrement) vote counts
+    deltas: dict[int, dict[int, int]] = {poll_id: {} for poll_id in poll_ids}
+    for x in upserted_votes:
+        if x.old_vote_option_id == x.vote_option_id:
+            continue
+        poll_deltas = deltas[x.poll_id]
+        if x.old_vote_option_id is not None:
+            old_count = poll_deltas.get(x.old_vote_option_id, 0)
+            poll_deltas[x.old_vote_option_id] = old_count - 1
+        poll_deltas[x.vote_option_id] = poll_deltas.get(x.vote_option_id, 0) + 1
+
+    # The counts in the database are updated in the same transaction as the votes
+    option_deltas = [
+        (vote_option_id, delta)
+        for poll_deltas in deltas.values()
+        for vote_option_id, delta in poll_deltas.items()
+        if delta != 0
     ]
-    await publish_poll_update(valkey, poll_id, vote_counts_list)
+    if option_deltas:
+        await q.apply_vote_count_deltas(
+            vote_option_ids=[vote_option_id for vote_option_id, _ in option_deltas],
+            deltas=[delta for _, delta in option_deltas],
+        )
+    await conn.commit()
+
+    # Atomically apply the same deltas to the vote counts in Valkey.
+    # Without a publisher, updates are published to Redis pub/sub right away
+    vote_counts = await apply_vote_deltas(
+        valkey, conn, deltas, publish=publisher is None
+    )
+    if publisher is not None:
+        for poll_id, poll_vote_counts in vote_counts.items():
+            await publisher.update(poll_id, poll_vote_counts)
+
+
+async def commit_processed(consumer: AIOKafkaConsumer, lanes: ConsumerLanes):
+    # Only mark messages as consumed once they (and all before them) are processed
+    offsets = lanes.committable_offsets(consumer.assignment())
+    if offsets:
+        await consumer.commit(offsets)
+        lanes.mark_committed(offsets)
+
+
+class DrainOnRebalance(ConsumerRebalanceListener):
+    """
+    Finishes processing and commits the messages of revoked partitions,
+    before another consumer process in the group takes over the partitions.
+    Otherwise, votes on a poll could be processed out of order by two processes.
+
+    The main loop might be halfway through submitting a fetched batch meanwhile.
+    The rest of the batch must not be submitted for revoked partitions,
+    their new owner replays it from the committed offset.
+    """
+
+    def __init__(self, lanes: ConsumerLanes):
+        self.lanes = lanes
+        self.consumer: AIOKafkaConsumer | None = None
+        # Partitions revoked since the main loop last fetched a batch
+        self.revoked: set[TopicPartition] = set()
+
+    async def on_partitions_revoked(self, revoked: list[TopicPartition]):
+        print(f"Partitions revoked: {sorted(tp.partition for tp in revoked)}")
+        self.revoked.update(revoked)
+        await self.lanes.drain()
+        if self.consumer is not None:
+            await commit_processed(self.consumer, self.lanes)
+
+    async def on_partitions_assigned(self, assigned: list[TopicPartition]):
+        print(f"Partitions assigned: {sorted(tp.partition for tp in assigned)}")
 
 
 def handle_shutdown_signal(signum: int, _frame: FrameType):
@@ -62,33 +163,77 @@ async def main():
     signal.signal(signal.SIGINT, handle_shutdown_signal)
     signal.signal(signal.SIGTERM, handle_shutdown_signal)
 
+    # Every lane holds on to its own database connection
     db_engine, _ = create_db_engine(settings)
     pool = ConnectionPool.from_url(settings.VALKEY_CONN_STR)
-    consumer = await create_kafka_consumer(settings)
+    publisher = (
+        PollUpdatePublisher(
+            Valkey(connection_pool=pool), settings.POLL_UPDATE_INTERVAL_MS / 1000
+        )
+        if settings.POLL_UPDATE_INTERVAL_MS > 0
+        else None
+    )
+
+    poll_metadata = TieredPollMetadataCache(
+        pool,
+        max_size=settings.POLL_METADATA_CACHE_MAX_SIZE,
+        ttl=settings.POLL_METADATA_CACHE_TTL_S,
+    )
+    poll_metadata.start()
+
+    # Summed with those of the API workers on their /metrics endpoint
+    metrics_task = asyncio.create_task(
+        keep_writing_metrics(pool, settings.METRICS_WRITE_INTERVAL_S)
+    )
+
+    lanes = ConsumerLanes(
+        settings.CONSUMER_LANES,
+        settings.CONSUMER_MAX_BATCH_SIZE,
+        db_engine,
+        pool,
+        partial(process_votes, poll_metadata=poll_metadata, publisher=publisher),
+    )
+    lanes.start()
+
+    rebalance_listener = DrainOnRebalance(lanes)
+    consumer = await create_kafka_consumer(settings, rebalance_listener)
+    rebalance_listener.consumer = consumer
 
     print("Consumer started, processing vote events...")
     print("Press Ctrl+C to gracefully shutdown")
 
     try:
         while not shutdown_event.is_set():
-            try:
-                # Get messages while periodically checking for shutdown signals
-                msg = await asyncio.wait_for(consumer.getone(), timeout=1.0)
-
-                # TODO: what should happen on a deleted / nonexistent poll?
-                poll_id: int = msg.key
-                ve: VoteEvent = msg.value
-                recv_time = datetime.fromtimestamp(
-                    msg.timestamp / 1000, tz=timezone.utc
-                )
-
-                async with db_engine.begin() as conn, Valkey(
-                    connection_pool=pool
-                ) as valkey:
-                    await process_vote(poll_id, ve, recv_time, conn, valkey)
-            except asyncio.TimeoutError:
-                continue
+            lanes.check()
+
+            # Get messages while periodically checking for shutdown signals
+            rebalance_listener.revoked.clear()
+            batch = await consumer.getmany(
+                timeout_ms=1000, max_records=settings.CONSUMER_MAX_BATCH_SIZE
+            )
+
+            for tp, msgs in batch.items():
+                for msg in msgs:
+                    # Even if reassigned, it is fetched again from the committed offset
+                    if tp in rebalance_listener.revoked:
+                        break
+                    await lanes.submit(msg)
+
+            await commit_processed(consumer, lanes)
+
+        print("Processing remaining vote events...")
+        await lanes.drain()
+        lanes.check()
+        await commit_processed(consumer, lanes)
     finally:
+        print("Stopping consumer lanes...")
+        await lanes.stop()
+        if publisher is not None:
+            print("Publishing pending poll updates...")
+            await publisher.flush()
+        await poll_metadata.stop()
+        _ = metrics_task.cancel()
+        _ = await asyncio.gather(metrics_task, return_exceptions=True)
         print("Stopping Kafka consumer...")
         await consumer.stop()
         print("Closing database connection pool...")
@@ -98,5 +243,79 @@ async def main():
         print("Consumer shutdown complete")
 
 
-if __name__ == "__main__":
+def run_worker():
     uvloop.run(main())
+
+
+async def supervise(workers: str):
+    """
+    Run several consumer processes in the same consumer group,
+    restarting them if they crash.
+    Kafka divides the partitions of the topic between them.
+    """
+    signal.signal(signal.SIGINT, handle_shutdown_signal)
+    signal.signal(signal.SIGTERM, handle_shutdown_signal)
+
+    if workers == "auto":
+        # More processes than partitions would sit idle
+        partition_count = await get_vote_event_partition_count(Settings())
+        num_workers = min(partition_count, os.cpu_count() or 1)
+        print(f"Topic {VOTE_EVENT_TOPIC} has {partition_count} partition(s)")
+    else:
+        num_workers = int(workers)
+
+    # Start every worker with a fresh interpreter, rather than a copy of this one
+    ctx = multiprocessing.get_context("spawn")
+
+    def start_worker(i: int) -> BaseProcess:
+        process = ctx.Process(target=run_worker, name=f"vote-consumer-{i}")
+        process.start()
+        print(f"Started {process.name} (pid {process.pid})")
+        return process
+
+    processes = [start_worker(i) for i in range(num_workers)]
+    exited_at: dict[int, float] = {}
+
+    while not shutdown_event.is_set():
+        await asyncio.sleep(1)
+
+        for i, process in enumerate(processes):
+            if process.is_alive():
+                continue
+
+            # Back off, so a worker that keeps crashing doesn't spin
+            now = time.monotonic()
+            if i not in exited_at:
+                print(f"{process.name} exited with code {process.exitcode}")
+                exited_at[i] = now
+            if now - exited_at[i] >= _WORKER_RESTART_DELAY_S:
+                del exited_at[i]
+                processes[i] = start_worker(i)
+
+    # Workers shut down gracefully on SIGTERM, just like this process
+    print("Stopping workers...")
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+    for process in processes:
+        await asyncio.to_thread(process.join, _WORKER_SHUTDOWN_TIMEOUT_S)
+        if process.is_alive():
+            print(f"{process.name} did not stop in time, killing it")
+            process.kill()
+    print("Supervisor shutdown complete")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Process vote events from Kafka")
+    parser.add_argument(
+        "--workers",
+        default="1",
+        help="number of consumer processes, or 'auto' for one per topic partition "
+        "(up to the number of CPU cores)",
+    )
+    args = parser.parse_args()
+
+    if args.workers == "1":
+        uvloop.run(main())
+    else:
+        uvloop.run(supervise(args.workers))
@@ -1,31 +1,136 @@
+import asyncio
+import logging
+import struct
+import time
 from collections.abc import Generator
-from typing import Annotated
+from functools import partial
+from typing import Annotated, Literal
 
-from aiokafka import AIOKafkaConsumer, AIOKafkaProducer
+from aiokafka import AIOKafkaConsumer, AIOKafkaProducer, ConsumerRebalanceListener
+from aiokafka.partitioner import DefaultPartitioner
 from fastapi import Depends, Request
 from pydantic import BaseModel
 
 from app.config import Settings
+from app.utils.metrics import Counter, Histogram
+
+logger = logging.getLogger(__name__)
 
 VOTE_EVENT_TOPIC = "vote-event"
 
+_vote_events_sent = Counter(
+    "vote_events_sent_total",
+    "Vote events sent to Kafka, by delivery result",
+    labelnames=["result"],
+)
+_vote_event_send_wait = Histogram(
+    "vote_event_send_wait_seconds",
+    "Time spent waiting for room in the producer buffer",
+)
+_vote_event_delivery = Histogram(
+    "vote_event_delivery_seconds",
+    "Time from queueing a vote event until it is acknowledged by Kafka",
+)
+
 
 class VoteEvent(BaseModel):
     user_id: int
     poll_option_id: int
 
 
+# Keys and values start with a header byte giving the version of their format.
+# Version 1 is fixed-width, big-endian binary:
+#   key: header, poll_id (int64)
+#   value: header, user_id (int64), poll_option_id (int64)
+# Messages from before versioning are ASCII keys and JSON values,
+# which never start with a byte this small, so they can still be decoded.
+_WIRE_FORMAT_V1 = 1
+_KEY_V1 = struct.Struct(">Bq")
+_VALUE_V1 = struct.Struct(">Bqq")
+
+
+class ProducerProfile(BaseModel):
+    linger_ms: int
+    max_batch_size: int
+    compression: Literal["none", "gzip"]
+    acks: Literal["0", "1", "all"]
+
+
+PRODUCER_PROFILES = {
+    # Send every vote right away
+    "latency": ProducerProfile(
+        linger_ms=0, max_batch_size=16 * 1024, compression="none", acks="1"
+    ),
+    # Wait a little to send fewer, larger and compressed batches to the brokers
+    "throughput": ProducerProfile(
+        linger_ms=20, max_batch_size=256 * 1024, compression="gzip", acks="1"
+    ),
+}
+
+
+def get_producer_profile(settings: Settings) -> ProducerProfile:
+    """Get the configured producer profile, with overrides from the settings"""
+    overrides = {
+        "linger_ms": settings.KAFKA_PRODUCER_LINGER_MS,
+        "max_batch_size": settings.KAFKA_PRODUCER_MAX_BATCH_SIZE,
+        "compression": settings.KAFKA_PRODUCER_COMPRESSION,
+        "acks": settings.KAFKA_PRODUCER_ACKS,
+    }
+    return PRODUCER_PROFILES[settings.KAFKA_PRODUCER_PROFILE].model_copy(
+        update={k: v for k, v in overrides.items() if v is not None}
+    )
+
+
 # TODO: dev/test/docker/prod environment distinction
 async def create_kafka_producer(settings: Settings):
+    profile = get_producer_profile(settings)
+    print(f"Kafka producer profile {settings.KAFKA_PRODUCER_PROFILE}: {profile}")
+
     producer = AIOKafkaProducer(
         bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS,
         key_serializer=_serialize_key,
         value_serializer=_serialize_value,
+        partitioner=_partition_by_poll_id,
+        linger_ms=profile.linger_ms,
+        max_batch_size=profile.max_batch_size,
+        compression_type=None if profile.compression == "none" else profile.compression,
+        acks=profile.acks if profile.acks == "all" else int(profile.acks),
     )
     await producer.start()
     return producer
 
 
+async def send_vote_event(
+    producer: AIOKafkaProducer, poll_id: int, vote: VoteEvent, timestamp_ms: int
+):
+    """
+    Queue a vote event to be sent to Kafka, keyed by its poll.
+    Only waits if the producer buffer is full, delivery is tracked in the background.
+    """
+    start = time.perf_counter()
+    delivery = await producer.send(
+        topic=VOTE_EVENT_TOPIC,
+        value=vote,
+        # not a key in the sense of dictionaries, rather a hint for partitioning
+        key=poll_id,
+        timestamp_ms=timestamp_ms,
+    )
+    queued = time.perf_counter()
+    _vote_event_send_wait.observe(queued - start)
+    delivery.add_done_callback(partial(_on_vote_event_delivered, queued))
+
+
+def _on_vote_event_delivered(queued: float, delivery: asyncio.Future[object]):
+    if delivery.cancelled() or delivery.exception() is not None:
+        _vote_events_sent.inc(result="failed")
+        error = "cancelled" if delivery.cancelled() else delivery.exception()
+        logger.error(f"Failed to deliver vote event: {error}")
+        return
+
+    _vote_events_sent.inc(result="delivered")
+    _vote_event_delivery.observe(time.perf_counter() - queued)
+
+
 def _get_kafka_producer(request: Request) -> Generator[AIOKafkaProducer, None]:
     yield request.app.state.kafka_producer
 
@@ -34,41 +139,75 @@ def _get_kafka_producer(request: Request) -> Generator[AIOKafkaProducer, None]:
 KafkaProducer = Annotated[AIOKafkaProducer, Depends(_get_kafka_producer)]
 
 
-async def create_kafka_consumer(settings: Settings):
+async def create_kafka_consumer(
+    settings: Settings, listener: ConsumerRebalanceListener | None = None
+):
     """
     Create a Kafka consumer, configured in such a way that every message
     will be consumed **at least once**.
+    Offsets are committed manually, after a batch of messages has been processed.
 
-    TODO: one consumer process per partition
+    Several consumer processes can share the work, as they are in the same group.
     """
     consumer = AIOKafkaConsumer(
-        VOTE_EVENT_TOPIC,
         bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS,
         group_id="vote-event-processor",
         auto_offset_reset="earliest",
-        enable_auto_commit=True,
-        auto_commit_interval_ms=5000,
+        enable_auto_commit=False,
         key_deserializer=_deserialize_key,
         value_deserializer=_deserialize_value,
     )
+    consumer.subscribe([VOTE_EVENT_TOPIC], listener=listener)
     await consumer.start()
     return consumer
 
 
+async def get_vote_event_partition_count(settings: Settings) -> int:
+    """Get the number of partitions of the vote event topic"""
+    consumer = AIOKafkaConsumer(bootstrap_servers=settings.KAFKA_BOOTSTRAP_SERVERS)
+    await consumer.start()
+    try:
+        _ = await consumer.topics()  # Fetches metadata for all topics
+        partitions = consumer.partitions_for_topic(VOTE_EVENT_TOPIC)
+    finally:
+        await consumer.stop()
+
+    # The topic might not exist yet, if nothing has been voted on
+    return len(partitions) if partitions else 1
+
+
+def _partition_by_poll_id(
+    key: bytes | None, all_partitions: list[int], available: list[int]
+) -> int:
+    """
+    Partition by the poll id in its legacy ASCII form, so a poll stays on
+    the same partition regardless of the key format it was produced with.
+    Otherwise, votes on a poll could be processed out of order during a rollout.
+    """
+    if key is not None:
+        key = str(_deserialize_key(key)).encode()
+    return DefaultPartitioner()(key, all_partitions, available)
+
+
 def _serialize_key(k: int) -> bytes:
     """Serialize topic key (poll_id: int)"""
-    return str(k).encode()
+    return _KEY_V1.pack(_WIRE_FORMAT_V1, k)
 
 
 def _deserialize_key(k: bytes) -> int:
     """Deserialize topic key (poll_id: int)"""
-    return int(k.decode())
+    if k[0] == _WIRE_FORMAT_V1:
+        _, poll_id = _KEY_V1.unpack(k)
+        return poll_id
+    return int(k.decode())  # Legacy ASCII key
 
 
-# TODO: should we do this in a more efficient format?
 def _serialize_value(x: VoteEvent) -> bytes:
-    return x.model_dump_json().encode()
+    return _VALUE_V1.pack(_WIRE_FORMAT_V1, x.user_id, x.poll_option_id)
 
 
 def _deserialize_value(x: bytes) -> VoteEvent:
-    return VoteEvent.model_validate_json(x.decode())
+    if x[0] == _WIRE_FORMAT_V1:
+        _, user_id, poll_option_id = _VALUE_V1.unpack(x)
+        return VoteEvent(user_id=user_id, poll_option_id=poll_option_id)
+    return VoteEvent.model_validate_json(x.decode())  # Legacy JSON value
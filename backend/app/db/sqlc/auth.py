@@ -5,6 +5,7 @@
 import datetime
 from typing import Any, Optional
 
+import pydantic
 import sqlalchemy
 import sqlalchemy.ext.asyncio
 
@@ -17,6 +18,30 @@ SELECT can_user_do_at(
 """
 
 
+CAN_USER_DO_UNTIL = """-- name: can_user_do_until \\:one
+SELECT can_user_do_at(
+    :p1, :p2, :p3, now()) AS allowed,
+    (
+        SELECT min(b.boundary)
+        FROM poll_grants pg
+        JOIN role_permissions rp ON rp.role = pg.role
+        CROSS JOIN LATERAL (VALUES (lower(pg.period)), (upper(pg.period))) AS b(boundary)
+        WHERE rp.permission = :p3
+        AND b.boundary > now() AND isfinite(b.boundary)
+        AND (
+               (pg.scope = 'user_poll'   AND pg.user_id = :p1 AND pg.poll_id = :p2)
+            OR (pg.scope = 'user_global' AND pg.user_id = :p1)
+            OR (pg.scope = 'public_poll' AND pg.poll_id = :p2)
+        )
+    )\\:\\:timestamptz AS valid_until
+"""
+
+
+class CanUserDoUntilRow(pydantic.BaseModel):
+    allowed: Optional[bool]
+    valid_until: Optional[datetime.datetime]
+
+
 MAKE_MODERATOR = """-- name: make_moderator \\:exec
 INSERT INTO poll_grants (role, scope, user_id, expires_at)
 VALUES ('moderator', 'user_global', :p1, :p2)
@@ -59,6 +84,26 @@ class AsyncQuerier:
             return None
         return row[0]
 
+    async def can_user_do_until(
+        self,
+        *,
+        user_id: Optional[int],
+        poll_id: Optional[int],
+        permission: models.Permission
+    ) -> Optional[CanUserDoUntilRow]:
+        row = (
+            await self._conn.execute(
+                sqlalchemy.text(CAN_USER_DO_UNTIL),
+                {"p1": user_id, "p2": poll_id, "p3": permission},
+            )
+        ).first()
+        if row is None:
+            return None
+        return CanUserDoUntilRow(
+            allowed=row[0],
+            valid_until=row[1],
+        )
+
     async def make_moderator(
         self, *, user_id: Optional[int], expires_at: Optional[datetime.datetime]
     ) -> None:
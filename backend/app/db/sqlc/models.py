@@ -33,7 +33,7 @@ class Poll(pydantic.BaseModel):
     question: str
     expires_at: Optional[datetime.datetime]
     created_by: int
-    created_at: Optional[datetime.datetime]
+    created_at: datetime.datetime
 
 
 class PollGrant(pydantic.BaseModel):
@@ -65,6 +65,7 @@ class Vote(pydantic.BaseModel):
     user_id: int
     vote_option_id: int
     created_at: Optional[datetime.datetime]
+    poll_id: int
 
 
 class VoteOption(pydantic.BaseModel):
@@ -72,3 +73,8 @@ class VoteOption(pydantic.BaseModel):
     poll_id: int
     caption: str
     presentation_order: int
+
+
+class VoteOptionCount(pydantic.BaseModel):
+    vote_option_id: int
+    vote_count: int
@@ -3,7 +3,7 @@
 #   sqlc v1.30.0
 # source: poll.sql
 import datetime
-from typing import Any, AsyncIterator, List, Optional
+from typing import AsyncIterator, List, Optional
 
 import pydantic
 import sqlalchemy
@@ -11,29 +11,65 @@ import sqlalchemy.ext.asyncio
 
 from app.db.sqlc import models
 
-ASSIGN_PUBLIC_PERMS = """-- name: assign_public_perms \\:exec
-INSERT INTO poll_grants (role, scope, poll_id)
-VALUES (:p1, 'public_poll', :p2)
-"""
-
-
-ASSIGN_ROLE = """-- name: assign_role \\:exec
-INSERT INTO poll_grants (role, scope, user_id, poll_id)
-VALUES (:p1, 'user_poll', :p2, :p3)
+ASSIGN_ROLES = """-- name: assign_roles \\:many
+WITH requested AS (
+    SELECT * FROM unnest(
+        :p1\\:\\:bigint[],
+        :p2\\:\\:role[]
+    ) AS x(user_id, role)
+), granted AS (
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT r.role, 'user_poll', r.user_id, :p3
+    FROM requested r
+    WHERE EXISTS (SELECT 1 FROM "user" u WHERE u.id = r.user_id)
+    ON CONFLICT DO NOTHING  -- Also skips grants violating the exclusion constraint
+    RETURNING user_id, role
+)
+SELECT r.user_id FROM requested r
+WHERE NOT EXISTS (
+    SELECT 1 FROM granted g WHERE g.user_id = r.user_id AND g.role = r.role
+)
 """
 
 
 CREATE_POLL = """-- name: create_poll \\:one
-INSERT INTO poll (question, created_by, expires_at)
-VALUES (:p1, :p2, :p3)
-RETURNING id
+WITH new_poll AS (
+    INSERT INTO poll (question, created_by, expires_at)
+    VALUES (:p1, :p2, :p3)
+    RETURNING id, question, expires_at, created_by
+), creator_grant AS (
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT 'creator', 'user_poll', created_by, id FROM new_poll
+), public_grant AS (
+    INSERT INTO poll_grants (role, scope, poll_id)
+    SELECT :p4\\:\\:role, 'public_poll', id FROM new_poll
+    WHERE :p4\\:\\:role IS NOT NULL
+), new_vote_option AS (
+    INSERT INTO vote_option (caption, poll_id, presentation_order)
+    SELECT o.caption, p.id, o.ordinality - 1
+    FROM new_poll p
+    CROSS JOIN unnest(:p5\\:\\:text[]) WITH ORDINALITY AS o(caption, ordinality)
+    RETURNING id, caption, presentation_order
+)
+SELECT p.id, p.question, p.expires_at, u.username as creator_name,
+    array_agg(vo.caption ORDER BY vo.presentation_order)\\:\\:text[] AS options,
+    array_agg(vo.id ORDER BY vo.presentation_order)\\:\\:bigint[] AS option_ids,
+    NULL\\:\\:bigint AS user_vote
+FROM new_poll p
+INNER JOIN "user" u ON p.created_by = u.id
+CROSS JOIN new_vote_option vo
+GROUP BY p.id, p.question, p.expires_at, u.id
 """
 
 
-CREATE_VOTE_OPTION = """-- name: create_vote_option \\:exec
-INSERT INTO vote_option (caption, poll_id, presentation_order)
-VALUES (:p1, :p2, :p3)
-"""
+class CreatePollRow(pydantic.BaseModel):
+    id: int
+    question: str
+    expires_at: Optional[datetime.datetime]
+    creator_name: str
+    options: List[str]
+    option_ids: List[int]
+    user_vote: Optional[int]
 
 
 DELETE_GRANTS_FOR_POLL = """-- name: delete_grants_for_poll \\:exec
@@ -63,39 +99,63 @@ class GetActivePollRolesRow(pydantic.BaseModel):
     username: str
 
 
-GET_POLL = """-- name: get_poll \\:one
+GET_POLL_DOCUMENT = """-- name: get_poll_document \\:one
 SELECT p.id, p.question, p.expires_at, u.username as creator_name,
     array_agg(vo.caption ORDER BY vo.presentation_order)\\:\\:text[] AS options,
-    array_agg(vo.id ORDER BY vo.presentation_order)\\:\\:bigint[] AS option_ids,
-    max(v.vote_option_id) as user_vote
+    array_agg(vo.id ORDER BY vo.presentation_order)\\:\\:bigint[] AS option_ids
 FROM poll p
 INNER JOIN vote_option vo ON p.id = vo.poll_id
 INNER JOIN "user" u ON p.created_by = u.id
-LEFT JOIN vote v ON v.vote_option_id = vo.id AND v.user_id = :p1
-WHERE p.id = :p2 AND can_user_do_at(:p1, :p2, 'poll\\:view')
+WHERE p.id = :p1
 GROUP BY p.id, u.id
 """
 
 
-class GetPollRow(pydantic.BaseModel):
+class GetPollDocumentRow(pydantic.BaseModel):
     id: int
     question: str
     expires_at: Optional[datetime.datetime]
     creator_name: str
     options: List[str]
     option_ids: List[int]
-    user_vote: Any
+
+
+GET_POLL_METADATA = """-- name: get_poll_metadata \\:one
+SELECT p.id, p.expires_at, p.created_by,
+    array_agg(vo.id ORDER BY vo.presentation_order)\\:\\:bigint[] AS option_ids
+FROM poll p
+INNER JOIN vote_option vo ON p.id = vo.poll_id
+WHERE p.id = :p1
+GROUP BY p.id
+"""
+
+
+class GetPollMetadataRow(pydantic.BaseModel):
+    id: int
+    expires_at: Optional[datetime.datetime]
+    created_by: int
+    option_ids: List[int]
 
 
 GET_POLLS = """-- name: get_polls \\:many
-SELECT p.id, p.question, p.expires_at, u.username as creator_name,
+SELECT p.id, p.question, p.expires_at, p.created_at, u.username as creator_name,
     array_agg(vo.caption ORDER BY vo.presentation_order)\\:\\:text[] AS options,
     array_agg(vo.id ORDER BY vo.presentation_order)\\:\\:bigint[] AS option_ids
-FROM poll p
+FROM (
+    -- Walks poll_created_at_id_idx, checking every poll until the page is full
+    SELECT * FROM poll
+    WHERE can_view_poll(:p1, id)
+    AND (created_at, id) < (
+        coalesce(:p2\\:\\:timestamptz, 'infinity'),
+        coalesce(:p3\\:\\:bigint, 0)
+    )
+    ORDER BY created_at DESC, id DESC
+    LIMIT :p4
+) p
 INNER JOIN vote_option vo ON p.id = vo.poll_id
 INNER JOIN "user" u ON p.created_by = u.id
-WHERE can_user_do_at(:p1, p.id, 'poll\\:view')
-GROUP BY p.id, u.id
+GROUP BY p.id, p.question, p.expires_at, p.created_at, u.id
+ORDER BY p.created_at DESC, p.id DESC
 """
 
 
@@ -103,54 +163,57 @@ class GetPollsRow(pydantic.BaseModel):
     id: int
     question: str
     expires_at: Optional[datetime.datetime]
+    created_at: datetime.datetime
     creator_name: str
     options: List[str]
     option_ids: List[int]
 
 
-POLL_OPTION_BELONGS_TO_POLL = """-- name: poll_option_belongs_to_poll \\:one
-SELECT true FROM vote_option
-WHERE poll_id = :p1 AND id = :p2
-"""
-
-
 class AsyncQuerier:
     def __init__(self, conn: sqlalchemy.ext.asyncio.AsyncConnection):
         self._conn = conn
 
-    async def assign_public_perms(
-        self, *, role: models.Role, poll_id: Optional[int]
-    ) -> None:
-        await self._conn.execute(
-            sqlalchemy.text(ASSIGN_PUBLIC_PERMS), {"p1": role, "p2": poll_id}
-        )
-
-    async def assign_role(
-        self, *, role: models.Role, user_id: Optional[int], poll_id: Optional[int]
-    ) -> None:
-        await self._conn.execute(
-            sqlalchemy.text(ASSIGN_ROLE), {"p1": role, "p2": user_id, "p3": poll_id}
+    async def assign_roles(
+        self, *, user_ids: List[int], roles: List[models.Role], poll_id: Optional[int]
+    ) -> AsyncIterator[int]:
+        result = await self._conn.stream(
+            sqlalchemy.text(ASSIGN_ROLES),
+            {"p1": user_ids, "p2": roles, "p3": poll_id},
         )
+        async for row in result:
+            yield row[0]
 
     async def create_poll(
-        self, *, question: str, created_by: int, expires_at: Optional[datetime.datetime]
-    ) -> Optional[int]:
+        self,
+        *,
+        question: str,
+        created_by: int,
+        expires_at: Optional[datetime.datetime],
+        public_role: Optional[models.Role],
+        options: List[str]
+    ) -> Optional[CreatePollRow]:
         row = (
             await self._conn.execute(
                 sqlalchemy.text(CREATE_POLL),
-                {"p1": question, "p2": created_by, "p3": expires_at},
+                {
+                    "p1": question,
+                    "p2": created_by,
+                    "p3": expires_at,
+                    "p4": public_role,
+                    "p5": options,
+                },
             )
         ).first()
         if row is None:
             return None
-        return row[0]
-
-    async def create_vote_option(
-        self, *, caption: str, poll_id: int, presentation_order: int
-    ) -> None:
-        await self._conn.execute(
-            sqlalchemy.text(CREATE_VOTE_OPTION),
-            {"p1": caption, "p2": poll_id, "p3": presentation_order},
+        return CreatePollRow(
+            id=row[0],
+            question=row[1],
+            expires_at=row[2],
+            creator_name=row[3],
+            options=row[4],
+            option_ids=row[5],
+            user_vote=row[6],
         )
 
     async def delete_grants_for_poll(self, *, poll_id: Optional[int]) -> None:
@@ -178,47 +241,53 @@ class AsyncQuerier:
                 username=row[1],
             )
 
-    async def get_poll(
-        self, *, user_id: Optional[int], poll_id: int
-    ) -> Optional[GetPollRow]:
+    async def get_poll_document(self, *, id: int) -> Optional[GetPollDocumentRow]:
         row = (
-            await self._conn.execute(
-                sqlalchemy.text(GET_POLL), {"p1": user_id, "p2": poll_id}
-            )
+            await self._conn.execute(sqlalchemy.text(GET_POLL_DOCUMENT), {"p1": id})
         ).first()
         if row is None:
             return None
-        return GetPollRow(
+        return GetPollDocumentRow(
             id=row[0],
             question=row[1],
             expires_at=row[2],
             creator_name=row[3],
             options=row[4],
             option_ids=row[5],
-            user_vote=row[6],
         )
 
-    async def get_polls(self, *, user_id: Optional[int]) -> AsyncIterator[GetPollsRow]:
-        result = await self._conn.stream(sqlalchemy.text(GET_POLLS), {"p1": user_id})
+    async def get_poll_metadata(self, *, id: int) -> Optional[GetPollMetadataRow]:
+        row = (
+            await self._conn.execute(sqlalchemy.text(GET_POLL_METADATA), {"p1": id})
+        ).first()
+        if row is None:
+            return None
+        return GetPollMetadataRow(
+            id=row[0],
+            expires_at=row[1],
+            created_by=row[2],
+            option_ids=row[3],
+        )
+
+    async def get_polls(
+        self,
+        *,
+        user_id: Optional[int],
+        after_created_at: Optional[datetime.datetime],
+        after_id: Optional[int],
+        page_size: Optional[int]
+    ) -> AsyncIterator[GetPollsRow]:
+        result = await self._conn.stream(
+            sqlalchemy.text(GET_POLLS),
+            {"p1": user_id, "p2": after_created_at, "p3": after_id, "p4": page_size},
+        )
         async for row in result:
             yield GetPollsRow(
                 id=row[0],
                 question=row[1],
                 expires_at=row[2],
-                creator_name=row[3],
-                options=row[4],
-                option_ids=row[5],
-            )
-
-    async def poll_option_belongs_to_poll(
-        self, *, poll_id: int, poll_option_id: int
-    ) -> Optional[bool]:
-        row = (
-            await self._conn.execute(
-                sqlalchemy.text(POLL_OPTION_BELONGS_TO_POLL),
-                {"p1": poll_id, "p2": poll_option_id},
+                created_at=row[3],
+                creator_name=row[4],
+                options=row[5],
+                option_ids=row[6],
             )
-        ).first()
-        if row is None:
-            return None
-        return row[0]
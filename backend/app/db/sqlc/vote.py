@@ -2,7 +2,8 @@
 # versions:
 #   sqlc v1.30.0
 # source: vote.sql
-from typing import AsyncIterator, Optional
+import datetime
+from typing import AsyncIterator, List, Optional
 
 import pydantic
 import sqlalchemy
@@ -10,22 +11,45 @@ import sqlalchemy.ext.asyncio
 
 from app.db.sqlc import models
 
-DELETE_USER_VOTE_ON_POLL = """-- name: delete_user_vote_on_poll \\:one
-DELETE FROM vote
-WHERE vote_option_id IN (
-    SELECT id FROM vote_option WHERE poll_id = :p1
-) AND user_id = :p2
-RETURNING vote_option_id
+APPLY_VOTE_COUNT_DELTAS = """-- name: apply_vote_count_deltas \\:exec
+INSERT INTO vote_option_count (vote_option_id, vote_count)
+SELECT vote_option_id, delta FROM unnest(
+    :p1\\:\\:bigint[],
+    :p2\\:\\:bigint[]
+) AS x(vote_option_id, delta)
+ORDER BY vote_option_id
+ON CONFLICT (vote_option_id) DO UPDATE
+SET vote_count = vote_option_count.vote_count + EXCLUDED.vote_count
+"""
+
+
+AUTHORIZE_VOTE = """-- name: authorize_vote \\:one
+SELECT (CASE
+    WHEN NOT can_user_do_at(:p1, :p2, 'poll\\:vote', :p3)
+        THEN 'forbidden'
+    WHEN p.expires_at <= :p3 THEN 'expired'
+    WHEN NOT EXISTS (
+        SELECT 1 FROM vote_option vo
+        WHERE vo.poll_id = :p2 AND vo.id = :p4
+    ) THEN 'invalid_option'
+    ELSE 'ok'
+END)\\:\\:text AS result
+FROM (SELECT 1) AS always_one_row
+LEFT JOIN poll p ON p.id = :p2
+"""
+
+
+GET_USER_VOTE = """-- name: get_user_vote \\:one
+SELECT vote_option_id FROM vote
+WHERE user_id = :p1 AND poll_id = :p2
 """
 
 
 GET_VOTE_COUNTS = """-- name: get_vote_counts \\:many
-SELECT vo.id as vote_option_id, count(v.id) AS vote_count
-FROM poll p
-INNER JOIN vote_option vo ON p.id = vo.poll_id
-LEFT JOIN vote v ON v.vote_option_id = vo.id  -- Keep options with 0 votes
-WHERE p.id = :p1
-GROUP BY vo.id
+SELECT vo.id as vote_option_id, coalesce(c.vote_count, 0)\\:\\:bigint AS vote_count
+FROM vote_option vo
+LEFT JOIN vote_option_count c ON c.vote_option_id = vo.id  -- Keep options with 0 votes
+WHERE vo.poll_id = :p1
 ORDER BY vo.presentation_order
 """
 
@@ -35,23 +59,77 @@ class GetVoteCountsRow(pydantic.BaseModel):
     vote_count: int
 
 
-SUBMIT_VOTE = """-- name: submit_vote \\:exec
-INSERT INTO vote (user_id, vote_option_id)
-VALUES (:p1, :p2)
+UPSERT_VOTES = """-- name: upsert_votes \\:many
+WITH new_vote AS (
+    SELECT * FROM unnest(
+        :p1\\:\\:bigint[],
+        :p2\\:\\:bigint[],
+        :p3\\:\\:bigint[]
+    ) AS x(user_id, poll_id, vote_option_id)
+), old_vote AS (
+    -- Sees the votes as they were before the upsert, as all CTEs share a snapshot.
+    -- Not locked: rows the upsert modifies would be skipped by FOR UPDATE,
+    -- and the consumer lanes already serialize writers of a poll
+    SELECT v.user_id, v.poll_id, v.vote_option_id FROM vote v
+    INNER JOIN new_vote n ON n.user_id = v.user_id AND n.poll_id = v.poll_id
+), upserted AS (
+    INSERT INTO vote (user_id, poll_id, vote_option_id)
+    SELECT user_id, poll_id, vote_option_id FROM new_vote
+    ON CONFLICT (user_id, poll_id) DO UPDATE
+    SET vote_option_id = EXCLUDED.vote_option_id, created_at = now()
+    RETURNING user_id, poll_id, vote_option_id
+)
+SELECT u.poll_id, o.vote_option_id AS old_vote_option_id, u.vote_option_id
+FROM upserted u
+LEFT JOIN old_vote o ON o.user_id = u.user_id AND o.poll_id = u.poll_id
 """
 
 
+class UpsertVotesRow(pydantic.BaseModel):
+    poll_id: int
+    old_vote_option_id: Optional[int]
+    vote_option_id: int
+
+
 class AsyncQuerier:
     def __init__(self, conn: sqlalchemy.ext.asyncio.AsyncConnection):
         self._conn = conn
 
-    async def delete_user_vote_on_poll(
-        self, *, poll_id: int, user_id: int
-    ) -> Optional[int]:
+    async def apply_vote_count_deltas(
+        self, *, vote_option_ids: List[int], deltas: List[int]
+    ) -> None:
+        await self._conn.execute(
+            sqlalchemy.text(APPLY_VOTE_COUNT_DELTAS),
+            {"p1": vote_option_ids, "p2": deltas},
+        )
+
+    async def authorize_vote(
+        self,
+        *,
+        user_id: int,
+        poll_id: int,
+        timestamp: datetime.datetime,
+        vote_option_id: int
+    ) -> Optional[str]:
         row = (
             await self._conn.execute(
-                sqlalchemy.text(DELETE_USER_VOTE_ON_POLL),
-                {"p1": poll_id, "p2": user_id},
+                sqlalchemy.text(AUTHORIZE_VOTE),
+                {
+                    "p1": user_id,
+                    "p2": poll_id,
+                    "p3": timestamp,
+                    "p4": vote_option_id,
+                },
+            )
+        ).first()
+        if row is None:
+            return None
+        return row[0]
+
+    async def get_user_vote(self, *, user_id: int, poll_id: int) -> Optional[int]:
+        row = (
+            await self._conn.execute(
+                sqlalchemy.text(GET_USER_VOTE), {"p1": user_id, "p2": poll_id}
             )
         ).first()
         if row is None:
@@ -66,7 +144,16 @@ class AsyncQuerier:
                 vote_count=row[1],
             )
 
-    async def submit_vote(self, *, user_id: int, vote_option_id: int) -> None:
-        await self._conn.execute(
-            sqlalchemy.text(SUBMIT_VOTE), {"p1": user_id, "p2": vote_option_id}
+    async def upsert_votes(
+        self, *, user_ids: List[int], poll_ids: List[int], vote_option_ids: List[int]
+    ) -> AsyncIterator[UpsertVotesRow]:
+        result = await self._conn.stream(
+            sqlalchemy.text(UPSERT_VOTES),
+            {"p1": user_ids, "p2": poll_ids, "p3": vote_option_ids},
         )
+        async for row in result:
+            yield UpsertVotesRow(
+                poll_id=row[0],
+                old_vote_option_id=row[1],
+                vote_option_id=row[2],
+            )
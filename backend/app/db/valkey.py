@@ -1,3 +1,6 @@
+import asyncio
+import logging
+from collections.abc import Callable
 from typing import Annotated
 
 import valkey.asyncio as valkey
@@ -7,6 +10,10 @@ from pydantic import BaseModel
 from app.config import Settings
 from app.db.sqlc import vote as vote_queries
 
+logger = logging.getLogger(__name__)
+
+_RECONNECT_DELAY_S = 1
+
 
 async def create_valkey_pool(settings: Settings) -> valkey.ConnectionPool:
     pool = valkey.ConnectionPool.from_url(settings.VALKEY_CONN_STR)
@@ -27,6 +34,35 @@ async def _get_valkey_connection(request: Request):
 ValkeyConnection = Annotated[valkey.Valkey, Depends(_get_valkey_connection)]
 
 
+async def listen_to_topic(
+    pool: valkey.ConnectionPool,
+    topic: str,
+    on_message: Callable[[bytes], None],
+    on_subscribed: Callable[[], None],
+):
+    """
+    Call on_message for every message published to a topic, until cancelled.
+    Resubscribes after connection errors. Messages published in the meantime are lost,
+    so on_subscribed is called every time the subscription is (re)established.
+    """
+    while True:
+        try:
+            async with valkey.Valkey(
+                connection_pool=pool
+            ) as client, client.pubsub() as pubsub:
+                await pubsub.subscribe(topic)
+                on_subscribed()
+
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        on_message(message["data"])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error listening to Valkey topic {topic}: {e}")
+            await asyncio.sleep(_RECONNECT_DELAY_S)
+
+
 class PollUpdateEvent(BaseModel):
     poll_id: int
     vote_counts: list[vote_queries.GetVoteCountsRow]
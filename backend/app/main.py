@@ -1,11 +1,19 @@
+import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from fastapi.routing import APIRoute
 
+from app.auth.cookie import VerifiedTokenCache
+from app.auth.password import create_password_hashing_pool
+from app.auth.permission_cache import PermissionDecisionCache
 from app.db.kafka import create_kafka_producer
-from app.db.valkey import create_valkey_pool
+from app.db.valkey import ValkeyConnection, create_valkey_pool
 from app.sse.manager import SSEManager
+from app.utils.metrics import keep_writing_metrics, render_metrics
+from app.utils.poll_document import TieredPollDocumentCache
+from app.utils.poll_metadata import TieredPollMetadataCache
 
 from .config import get_settings
 from .db.db import create_db_engine
@@ -29,6 +37,40 @@ async def lifespan(app: FastAPI):
     pool = await create_valkey_pool(settings)
     app.state.valkey_pool = pool
 
+    print("Creating verified token cache")
+    app.state.verified_tokens = VerifiedTokenCache(settings.AUTH_TOKEN_CACHE_MAX_SIZE)
+
+    print("Creating password hashing pool")
+    password_hashing_pool = create_password_hashing_pool(settings)
+    app.state.password_hashing_pool = password_hashing_pool
+
+    print("Creating permission cache")
+    permission_cache = PermissionDecisionCache(
+        pool,
+        max_size=settings.PERMISSION_CACHE_MAX_SIZE,
+        ttl=settings.PERMISSION_CACHE_TTL_S,
+    )
+    permission_cache.start()
+    app.state.permission_cache = permission_cache
+
+    print("Creating poll metadata cache")
+    poll_metadata_cache = TieredPollMetadataCache(
+        pool,
+        max_size=settings.POLL_METADATA_CACHE_MAX_SIZE,
+        ttl=settings.POLL_METADATA_CACHE_TTL_S,
+    )
+    poll_metadata_cache.start()
+    app.state.poll_metadata_cache = poll_metadata_cache
+
+    print("Creating poll document cache")
+    poll_document_cache = TieredPollDocumentCache(
+        pool,
+        max_size=settings.POLL_DOCUMENT_CACHE_MAX_SIZE,
+        ttl=settings.POLL_DOCUMENT_CACHE_TTL_S,
+    )
+    poll_document_cache.start()
+    app.state.poll_document_cache = poll_document_cache
+
     print("Creating Kafka Producer")
     producer = await create_kafka_producer(settings)
     app.state.kafka_producer = producer
@@ -38,14 +80,36 @@ async def lifespan(app: FastAPI):
         settings.VALKEY_CONN_STR,
         max_connections_per_user=settings.SSE_MAX_CONNECTIONS_PER_USER,
         max_connections_total=settings.SSE_MAX_CONNECTIONS_TOTAL,
+        heartbeat_interval=settings.SSE_HEARTBEAT_INTERVAL_S,
     )
     app.state.sse_manager = sse_manager
 
+    print("Starting metrics writer")
+    metrics_task = asyncio.create_task(
+        keep_writing_metrics(pool, settings.METRICS_WRITE_INTERVAL_S)
+    )
+
     yield
 
     print("Shutting down SSE Manager")
     await sse_manager.shutdown()
 
+    print("Stopping metrics writer")
+    _ = metrics_task.cancel()
+    _ = await asyncio.gather(metrics_task, return_exceptions=True)
+
+    print("Stopping poll document cache")
+    await poll_document_cache.stop()
+
+    print("Stopping poll metadata cache")
+    await poll_metadata_cache.stop()
+
+    print("Stopping permission cache")
+    await permission_cache.stop()
+
+    print("Shutting down password hashing pool")
+    password_hashing_pool.shutdown()
+
     print("Disposing Valkey connection pool")
     await pool.aclose()
 
@@ -71,6 +135,16 @@ app.include_router(user.router)
 app.include_router(poll.router)
 app.include_router(vote.router)
 
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics(valkey: ValkeyConnection):
+    """
+    Metrics of every API worker and consumer process, in the Prometheus text format.
+    Other processes are up to METRICS_WRITE_INTERVAL_S behind
+    """
+    return await render_metrics(valkey)
+
+
 # Make the OpenAPI operation ids match the route function name
 # Ensures nicer names on the generated client
 for route in app.routes:
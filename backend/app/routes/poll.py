@@ -1,19 +1,33 @@
 import asyncio
+import base64
 from datetime import datetime
 from enum import Enum
+from typing import Annotated
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Query, Request, Response, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncEngine
 
 from app.db.sqlc.models import Permission, Role
 
 from ..auth.cookie import CurrentUserOptional, CurrentUserRequired
+from ..auth.permission_cache import PermissionCache
 from ..db.db import DBConnection
-from ..db.sqlc import auth as auth_queries, poll as poll_queries
+from ..db.sqlc import poll as poll_queries, vote as vote_queries
+from ..db.valkey import ValkeyConnection
+from ..utils.poll_document import (
+    PollDocumentCache,
+    PollWithUserVote,
+    with_user_vote,
+)
+from ..utils.poll_metadata import PollMetadata, PollMetadataCache
+from ..utils.vote_counter import forget_valkey_vote_table
 
 router = APIRouter(prefix="/poll", tags=["poll"])
 
+MAX_POLL_PAGE_SIZE = 100
+
 
 class PollPerms(Enum):
     PUBLIC_VIEW = "public_view"
@@ -35,13 +49,16 @@ class CreatePollPayload(BaseModel):
 
 @router.post(
     "/create",
-    response_model=poll_queries.GetPollRow,
+    response_model=PollWithUserVote,
     status_code=status.HTTP_201_CREATED,
 )
 async def create_poll(
     payload: CreatePollPayload,
     user: CurrentUserRequired,
     conn: DBConnection,
+    valkey: ValkeyConnection,
+    permissions: PermissionCache,
+    poll_metadata: PollMetadataCache,
 ):
     if len(payload.question) == 0 or len(payload.options) == 0:
         raise HTTPException(
@@ -49,52 +66,151 @@ async def create_poll(
             detail="You need to provide a question with at least 1 vote option",
         )
 
+    public_role = None
+    if payload.poll_perms == PollPerms.PUBLIC_VIEW:
+        public_role = Role.VIEWER
+    elif payload.poll_perms == PollPerms.PUBLIC_VOTE:
+        public_role = Role.VOTER
+
+    # Creates the poll, its options and grants in a single statement
     q = poll_queries.AsyncQuerier(conn)
-    poll_id = await q.create_poll(
-        question=payload.question, created_by=user.id, expires_at=payload.expires_at
+    poll = await q.create_poll(
+        question=payload.question,
+        created_by=user.id,
+        expires_at=payload.expires_at,
+        public_role=public_role,
+        options=payload.options,
     )
-    if poll_id is None:
+    if poll is None:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Could not store poll to database",
         )
 
-    await q.assign_role(user_id=user.id, poll_id=poll_id, role=Role.CREATOR)
-    if payload.poll_perms == PollPerms.PUBLIC_VIEW:
-        await q.assign_public_perms(poll_id=poll_id, role=Role.VIEWER)
-    elif payload.poll_perms == PollPerms.PUBLIC_VOTE:
-        await q.assign_public_perms(poll_id=poll_id, role=Role.VOTER)
-
-    coros = [
-        q.create_vote_option(caption=cap, poll_id=poll_id, presentation_order=i)
-        for i, cap in enumerate(payload.options)
-    ]
-    _ = await asyncio.gather(*coros)
-    poll = await q.get_poll(user_id=user.id, poll_id=poll_id)
+    # Decisions about this poll id might have been cached before it existed
+    await conn.commit()
+    await permissions.publish_invalidation(valkey, poll_id=poll.id)
+    await poll_metadata.put(
+        valkey,
+        poll.id,
+        PollMetadata(
+            id=poll.id,
+            expires_at=poll.expires_at,
+            created_by=user.id,
+            option_ids=poll.option_ids,
+        ),
+    )
 
     return poll
 
 
+def _encode_cursor(poll: poll_queries.GetPollsRow) -> str:
+    cursor = f"{poll.created_at.isoformat()}|{poll.id}"
+    return base64.urlsafe_b64encode(cursor.encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        created_at, poll_id = base64.urlsafe_b64decode(cursor).decode().split("|")
+        return datetime.fromisoformat(created_at), int(poll_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor"
+        )
+
+
+@router.get("/all", response_model=list[poll_queries.GetPollsRow])
+async def get_all_polls(
+    conn: DBConnection,
+    user: CurrentUserOptional,
+    response: Response,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_POLL_PAGE_SIZE)] = MAX_POLL_PAGE_SIZE,
+):
+    """
+    Lists the polls visible to the user, newest first, one page at a time.
+    If there are more polls, the cursor for the next page is in the X-Next-Cursor header.
+    """
+    after_created_at, after_id = _decode_cursor(cursor) if cursor else (None, None)
+
+    # Fetch one extra poll to know if there is a next page
+    q = poll_queries.AsyncQuerier(conn)
+    polls = [
+        x
+        async for x in q.get_polls(
+            user_id=user.id if user else None,
+            after_created_at=after_created_at,
+            after_id=after_id,
+            page_size=limit + 1,
+        )
+    ]
+    if len(polls) > limit:
+        polls = polls[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(polls[-1])
+    return polls
+
+
 @router.get(
-    "/all",
-    response_model=list[poll_queries.GetPollsRow],
-    status_code=status.HTTP_201_CREATED,
+    "/all/stream",
+    response_class=StreamingResponse,
+    responses={200: {"content": {"application/x-ndjson": {}}}},
 )
-async def get_all_polls(conn: DBConnection, user: CurrentUserOptional):
-    q = poll_queries.AsyncQuerier(conn)
-    return [x async for x in q.get_polls(user_id=user.id if user else None)]
+async def stream_all_polls(
+    request: Request, user: CurrentUserOptional, cursor: str | None = None
+):
+    """
+    Streams every poll visible to the user, newest first, as newline delimited JSON.
+    Polls are sent as they are read from the database, without building a list.
+    """
+    after_created_at, after_id = _decode_cursor(cursor) if cursor else (None, None)
 
+    # Uses its own connection, as it is needed until the response is done
+    db_semaphore: asyncio.Semaphore = request.app.state.db_semaphore
+    db_engine: AsyncEngine = request.app.state.db_engine
 
-@router.get("/{poll_id}", response_model=poll_queries.GetPollRow)
-async def get_poll_by_id(poll_id: int, conn: DBConnection, user: CurrentUserOptional):
-    q = poll_queries.AsyncQuerier(conn)
-    poll = await q.get_poll(poll_id=poll_id, user_id=user.id if user else None)
-    if poll is None:
+    async def poll_generator():
+        async with db_semaphore, db_engine.begin() as conn:
+            q = poll_queries.AsyncQuerier(conn)
+            async for poll in q.get_polls(
+                user_id=user.id if user else None,
+                after_created_at=after_created_at,
+                after_id=after_id,
+                page_size=None,
+            ):
+                yield poll.model_dump_json() + "\n"
+
+    return StreamingResponse(poll_generator(), media_type="application/x-ndjson")
+
+
+@router.get("/{poll_id}", response_model=PollWithUserVote)
+async def get_poll_by_id(
+    poll_id: int,
+    conn: DBConnection,
+    user: CurrentUserOptional,
+    valkey: ValkeyConnection,
+    permissions: PermissionCache,
+    poll_documents: PollDocumentCache,
+):
+    user_id = user.id if user else None
+    view_access = await permissions.can_user_do(
+        conn, user_id, poll_id, Permission.POLL_VIEW
+    )
+    document = await poll_documents.get(conn, valkey, poll_id) if view_access else None
+    if document is None:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="The requested poll does not exist, or access is not granted",
         )
-    return poll
+
+    # Only the vote of the user differs between users
+    user_vote = None
+    if user_id is not None:
+        v = vote_queries.AsyncQuerier(conn)
+        user_vote = await v.get_user_vote(user_id=user_id, poll_id=poll_id)
+
+    return Response(
+        content=with_user_vote(document, user_vote), media_type="application/json"
+    )
 
 
 @router.post("/assign/", response_model=list[int])
@@ -103,53 +219,48 @@ async def assign_role_to_user(
     payload: list[GiveAccessPayload],
     poll_id: int,
     conn: DBConnection,
+    valkey: ValkeyConnection,
+    permissions: PermissionCache,
 ):
-    a = auth_queries.AsyncQuerier(conn)
-    has_access = await a.can_user_do_at(
-        user_id=curr_user.id,
-        poll_id=poll_id,
-        permission=Permission.POLL_ASSIGN_ROLE,
-        timestamp=None,
+    has_access = await permissions.can_user_do(
+        conn, curr_user.id, poll_id, Permission.POLL_ASSIGN_ROLE
     )
-    if has_access is None or not has_access:
+    if not has_access:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You don't have assign access to this poll, or it does not exist",
         )
 
+    # Moderators are global, they can't be assigned to a single poll
+    grants = [x for x in payload if x.role != Role.MODERATOR]
+    rejected_user_ids = [x.user_id for x in payload if x.role == Role.MODERATOR]
+
     q = poll_queries.AsyncQuerier(conn)
-    marked_instances: list[int] = []
-    for instance in payload:
-        try:
-            if instance.role == Role.VOTER:
-                _ = q.assign_role(
-                    role=Role.VOTER, user_id=instance.user_id, poll_id=poll_id
-                )
-            elif instance.role == Role.VIEWER:
-                _ = q.assign_role(
-                    role=Role.VIEWER, user_id=instance.user_id, poll_id=poll_id
-                )
-            elif instance.role == Role.CREATOR:
-                _ = q.assign_role(
-                    role=Role.CREATOR, user_id=instance.user_id, poll_id=poll_id
-                )
-        except IntegrityError:
-            marked_instances.append(instance.user_id)
-    return marked_instances
+    rejected_user_ids += [
+        user_id
+        async for user_id in q.assign_roles(
+            user_ids=[x.user_id for x in grants],
+            roles=[x.role for x in grants],
+            poll_id=poll_id,
+        )
+    ]
+
+    await conn.commit()
+    await permissions.publish_invalidation(valkey, poll_id=poll_id)
+    return rejected_user_ids
 
 
 @router.get("/users{poll_id}", response_model=list[poll_queries.GetActivePollRolesRow])
 async def get_users_for_poll(
-    user: CurrentUserRequired, conn: DBConnection, poll_id: int
+    user: CurrentUserRequired,
+    conn: DBConnection,
+    poll_id: int,
+    permissions: PermissionCache,
 ):
-    a = auth_queries.AsyncQuerier(conn)
-    has_access = await a.can_user_do_at(
-        user_id=user.id,
-        poll_id=poll_id,
-        permission=Permission.POLL_DELETE,
-        timestamp=None,
+    has_access = await permissions.can_user_do(
+        conn, user.id, poll_id, Permission.POLL_DELETE
     )
-    if has_access is None or not has_access:
+    if not has_access:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You don't have get access to this poll, or it does not exist",
@@ -162,16 +273,18 @@ async def get_users_for_poll(
 
 @router.delete("/{poll_id}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_poll_by_id(
-    poll_id: int, user: CurrentUserRequired, conn: DBConnection
+    poll_id: int,
+    user: CurrentUserRequired,
+    conn: DBConnection,
+    valkey: ValkeyConnection,
+    permissions: PermissionCache,
+    poll_metadata: PollMetadataCache,
+    poll_documents: PollDocumentCache,
 ):
-    a = auth_queries.AsyncQuerier(conn)
-    delete_access = await a.can_user_do_at(
-        user_id=user.id,
-        poll_id=poll_id,
-        permission=Permission.POLL_DELETE,
-        timestamp=None,
+    delete_access = await permissions.can_user_do(
+        conn, user.id, poll_id, Permission.POLL_DELETE
     )
-    if delete_access is None or not delete_access:
+    if not delete_access:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="You don't have delete access to this poll, or it does not exist",
@@ -181,3 +294,9 @@ async def delete_poll_by_id(
     await q.delete_grants_for_poll(poll_id=poll_id)
     await q.delete_vote_options_for_poll(poll_id=poll_id)
     await q.delete_poll(id=poll_id)
+
+    await conn.commit()
+    await permissions.publish_invalidation(valkey, poll_id=poll_id)
+    await poll_metadata.publish_invalidation(valkey, poll_id)
+    await poll_documents.publish_invalidation(valkey, poll_id)
+    forget_valkey_vote_table(poll_id)
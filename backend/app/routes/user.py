@@ -1,4 +1,3 @@
-from argon2 import PasswordHasher
 from fastapi import APIRouter, HTTPException, Response, status
 from pydantic import BaseModel, EmailStr
 from sqlalchemy.exc import IntegrityError
@@ -6,6 +5,7 @@ from sqlalchemy.exc import IntegrityError
 from app.utils.user_info import UserInfo, user_info_from_user
 
 from ..auth.cookie import CurrentUserRequired, clear_auth_cookie, set_auth_cookie
+from ..auth.password import PasswordHashing
 from ..db.db import DBConnection
 from ..db.sqlc import user as user_queries
 
@@ -20,10 +20,12 @@ class CreateUserPayload(BaseModel):
 
 @router.post("/register", response_model=UserInfo, status_code=status.HTTP_201_CREATED)
 async def register_user(
-    payload: CreateUserPayload, conn: DBConnection, response: Response
+    payload: CreateUserPayload,
+    conn: DBConnection,
+    response: Response,
+    password_hashing: PasswordHashing,
 ):
-    ph = PasswordHasher()
-    password_hash = ph.hash(payload.password)
+    password_hash = await password_hashing.hash(payload.password)
 
     q = user_queries.AsyncQuerier(conn)
     try:
@@ -49,14 +51,20 @@ class LoginPayload(BaseModel):
 
 
 @router.post("/login", status_code=status.HTTP_204_NO_CONTENT)
-async def login(payload: LoginPayload, response: Response, conn: DBConnection):
+async def login(
+    payload: LoginPayload,
+    response: Response,
+    conn: DBConnection,
+    password_hashing: PasswordHashing,
+):
     q = user_queries.AsyncQuerier(conn)
     user = await q.get_user_by_username_or_email(username=payload.username)
 
     # TODO: maybe secure against timing attacks
-    ph = PasswordHasher()
     validated = (
-        ph.verify(user.password_hash, payload.password) if user is not None else False
+        await password_hashing.verify(user.password_hash, payload.password)
+        if user is not None
+        else False
     )
 
     if user is None or not validated:
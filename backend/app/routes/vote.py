@@ -1,5 +1,4 @@
-import asyncio
-import json
+import math
 from datetime import datetime, timezone
 
 from fastapi import APIRouter, HTTPException, Request, status
@@ -7,15 +6,16 @@ from pydantic import BaseModel
 from sse_starlette.sse import EventSourceResponse
 from valkey.asyncio import Valkey
 
-from app.db.kafka import VOTE_EVENT_TOPIC, KafkaProducer, VoteEvent
+from app.db.kafka import KafkaProducer, VoteEvent, send_vote_event
 from app.db.sqlc.models import Permission
-from app.db.valkey import PollUpdateEvent
-from app.sse.manager import SSEManager
-from app.utils.vote_counter import ensure_valkey_vote_table, vote_table_key
+from app.sse.manager import SSEManager, vote_update_frame
+from app.utils.poll_metadata import PollMetadata, PollMetadataCache
+from app.utils.vote_counter import get_valkey_vote_counts
 
 from ..auth.cookie import CurrentUserOptional, CurrentUserRequired
+from ..auth.permission_cache import PermissionCache, PermissionDecisionCache
 from ..db.db import DBConnection
-from ..db.sqlc import auth as auth_queries, poll as poll_queries, vote as vote_queries
+from ..db.sqlc import vote as vote_queries
 from ..db.valkey import ValkeyConnection
 
 router = APIRouter(prefix="/vote", tags=["vote"])
@@ -26,45 +26,76 @@ class VotePayload(BaseModel):
     poll_id: int
 
 
+async def _authorize_vote_cached(
+    metadata: PollMetadata,
+    user_id: int,
+    vote_option_id: int,
+    timestamp: datetime,
+    conn: DBConnection,
+    permissions: PermissionDecisionCache,
+) -> str:
+    """Same checks and results as the AuthorizeVote query, using cached data"""
+    if not await permissions.can_user_do(
+        conn, user_id, metadata.id, Permission.POLL_VOTE
+    ):
+        return "forbidden"
+    if metadata.expires_at is not None and metadata.expires_at <= timestamp:
+        return "expired"
+    if vote_option_id not in metadata.option_ids:
+        return "invalid_option"
+    return "ok"
+
+
 @router.post("/submit", status_code=status.HTTP_201_CREATED)
 async def submit_vote(
     user: CurrentUserRequired,
     payload: VotePayload,
     conn: DBConnection,
+    valkey: ValkeyConnection,
     producer: KafkaProducer,
+    permissions: PermissionCache,
+    poll_metadata: PollMetadataCache,
 ):
     recv_time = datetime.now(tz=timezone.utc)
     recv_time = recv_time.replace(microsecond=(recv_time.microsecond // 1000) * 1000)
     recv_unix_ms = int(recv_time.timestamp() * 1000)
 
-    a = auth_queries.AsyncQuerier(conn)
-    vote_access = await a.can_user_do_at(
-        user_id=user.id,
-        poll_id=payload.poll_id,
-        permission=Permission.POLL_VOTE,
-        timestamp=recv_time,
-    )
-    if vote_access is None or not vote_access:
+    # Poll metadata and permissions are usually cached, then no database is needed.
+    # Otherwise, everything is checked in a single round trip
+    metadata = await poll_metadata.get_cached(valkey, payload.poll_id)
+    if metadata is not None:
+        result = await _authorize_vote_cached(
+            metadata, user.id, payload.vote_option_id, recv_time, conn, permissions
+        )
+    else:
+        v = vote_queries.AsyncQuerier(conn)
+        result = await v.authorize_vote(
+            user_id=user.id,
+            poll_id=payload.poll_id,
+            timestamp=recv_time,
+            vote_option_id=payload.vote_option_id,
+        )
+
+    if result == "forbidden":
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="You don't have voting rights for this poll",
         )
-
-    p = poll_queries.AsyncQuerier(conn)
-    ok = await p.poll_option_belongs_to_poll(
-        poll_id=payload.poll_id, poll_option_id=payload.vote_option_id
-    )
-    if ok is None or not ok:
+    if result == "expired":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="The poll has expired",
+        )
+    if result != "ok":
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="The provided poll option is not valid for the poll",
         )
 
-    await producer.send(
-        topic=VOTE_EVENT_TOPIC,
-        value=VoteEvent(user_id=user.id, poll_option_id=payload.vote_option_id),
-        # not a key in the sense of dictionaries, rather a hint for partitioning
-        key=payload.poll_id,
+    await send_vote_event(
+        producer,
+        payload.poll_id,
+        VoteEvent(user_id=user.id, poll_option_id=payload.vote_option_id),
         timestamp_ms=recv_unix_ms,
     )
 
@@ -76,15 +107,8 @@ async def get_votes_for_poll(
     poll_id: int, conn: DBConnection, valkey: ValkeyConnection
 ):
     """This endpoint is deprecated, use the SSE one instead"""
-    await ensure_valkey_vote_table(poll_id, conn, valkey)
-
     # Get materialized vote counts from valkey
-    vote_counts: dict[int, int] = await valkey.hgetall(vote_table_key(poll_id))
-
-    return [
-        vote_queries.GetVoteCountsRow(vote_option_id=k, vote_count=v)
-        for k, v in vote_counts.items()
-    ]
+    return await get_valkey_vote_counts(poll_id, conn, valkey)
 
 
 @router.get("/stream/{poll_id}")
@@ -92,6 +116,8 @@ async def stream_vote_updates(
     poll_id: int,
     request: Request,
     user: CurrentUserOptional,
+    permissions: PermissionCache,
+    poll_metadata: PollMetadataCache,
 ):
     """SSE endpoint for live poll vote counts"""
     user_id = user.id if user else None
@@ -106,31 +132,26 @@ async def stream_vote_updates(
         connection_pool=valkey_pool
     ) as valkey_conn:
         # Check permissions
-        a = auth_queries.AsyncQuerier(conn)
-        view_access = await a.can_user_do_at(
-            user_id=user_id,
-            poll_id=poll_id,
-            permission=Permission.POLL_VIEW,
-            timestamp=None,
+        view_access = await permissions.can_user_do(
+            conn, user_id, poll_id, Permission.POLL_VIEW
         )
-        if view_access is None or not view_access:
+        if not view_access:
             raise HTTPException(
                 status_code=status.HTTP_403_FORBIDDEN,
                 detail="You don't have permission to view this poll",
             )
 
+        # Also warms the poll metadata cache for voters of the poll
+        metadata = await poll_metadata.get(conn, valkey_conn, poll_id)
+        if metadata is None:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail="The requested poll does not exist",
+            )
+
         # Get initial data so the client won't have to wait for an update
-        await ensure_valkey_vote_table(poll_id, conn, valkey_conn)
-        vote_counts: dict[bytes, bytes] = await valkey_conn.hgetall(
-            vote_table_key(poll_id)
-        )
-        initial_data = [
-            {
-                "vote_option_id": int(k.decode()),
-                "vote_count": int(v.decode()),
-            }
-            for k, v in vote_counts.items()
-        ]
+        vote_counts = await get_valkey_vote_counts(poll_id, conn, valkey_conn)
+        initial_frame = vote_update_frame(vote_counts)
 
     # TODO: dependency inject?
     sse_manager: SSEManager = request.app.state.sse_manager
@@ -138,7 +159,7 @@ async def stream_vote_updates(
     async def event_generator():
         # Try to subscribe through the manager, might fail on too many connections
         try:
-            client_queue = await sse_manager.subscribe(poll_id, user_id)
+            slot = await sse_manager.subscribe(poll_id, user_id)
         except RuntimeError as e:
             yield {
                 "event": "error",
@@ -147,31 +168,22 @@ async def stream_vote_updates(
             return
 
         try:
-            # Send initial vote counts
-            yield {"event": "vote_update", "data": json.dumps(initial_data)}
-
+            # Send initial vote counts, and wait for updates after subscribing
+            version = slot.version
+            yield initial_frame
+
+            # Wait for updates, or the shared heartbeat to send a keepalive.
+            # Updates are already encoded, and shared by all clients of the poll.
+            # On disconnect, EventSourceResponse cancels this generator,
+            # as it's already waiting for it on the ASGI receive channel
             while True:
-                if await request.is_disconnected():
-                    break
-
-                # Wait for updates, but periodically send keepalives
-                try:
-                    event: PollUpdateEvent = await asyncio.wait_for(
-                        client_queue.get(), timeout=30.0
-                    )
-
-                    data = [
-                        {
-                            "vote_option_id": row.vote_option_id,
-                            "vote_count": row.vote_count,
-                        }
-                        for row in event.vote_counts
-                    ]
-
-                    yield {"event": "vote_update", "data": json.dumps(data)}
-                except asyncio.TimeoutError:
-                    yield {"comment": "keepalive"}
+                version, frame = await slot.wait_for_update(
+                    version, sse_manager.heartbeat
+                )
+                yield frame
         finally:
-            await sse_manager.unsubscribe(poll_id, user_id, client_queue)
+            await sse_manager.unsubscribe(poll_id, user_id)
 
-    return EventSourceResponse(event_generator())
+    # Keepalives are sent by the shared heartbeat instead of a ping task per client.
+    # An infinite interval keeps that task asleep (0 only disables it in newer versions)
+    return EventSourceResponse(event_generator(), ping=math.inf)
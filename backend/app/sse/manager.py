@@ -2,13 +2,89 @@ import asyncio
 import logging
 from collections import defaultdict
 
+from pydantic import TypeAdapter
 from valkey.asyncio import Valkey
 from valkey.asyncio.client import PubSub
 
+from app.db.sqlc import vote as vote_queries
 from app.db.valkey import PollUpdateEvent, poll_update_topic
 
 logger = logging.getLogger(__name__)
 
+_vote_counts_adapter = TypeAdapter(list[vote_queries.GetVoteCountsRow])
+
+KEEPALIVE_FRAME = b": keepalive\r\n\r\n"
+
+
+def vote_update_frame(vote_counts: list[vote_queries.GetVoteCountsRow]) -> bytes:
+    """
+    Encode vote counts as a complete SSE vote_update event, ready to be sent as is.
+    The JSON is compact, so it can't contain a line break
+    """
+    data = _vote_counts_adapter.dump_json(vote_counts)
+    return b"event: vote_update\r\ndata: " + data + b"\r\n\r\n"
+
+
+class Heartbeat:
+    """
+    A single tick shared by all SSE streams of the worker, to send keepalives
+    to idle clients. Every tick resolves one future that all idle streams wait on,
+    instead of every stream running its own timer
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.tick: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            tick = self.tick
+            self.tick = asyncio.get_running_loop().create_future()
+            tick.set_result(None)
+
+
+class PollSlot:
+    """
+    The latest update of a poll, shared by all of its clients.
+
+    Every update bumps the version, and resolves a future shared by all waiting clients.
+    Clients only remember the last version they have sent,
+    and skip to the latest update if they fall behind.
+    """
+
+    def __init__(self):
+        self.frame = b""
+        self.version = 0
+        self.subscribers = 0
+        self.updated: asyncio.Future[None] = asyncio.get_running_loop().create_future()
+
+    def publish(self, frame: bytes):
+        """Replace the latest update, and wake up all waiting clients"""
+        self.frame = frame
+        self.version += 1
+        updated = self.updated
+        self.updated = asyncio.get_running_loop().create_future()
+        updated.set_result(None)
+
+    async def wait_for_update(
+        self, version: int, heartbeat: Heartbeat | None = None
+    ) -> tuple[int, bytes]:
+        """
+        Wait for an update newer than version. Returns the latest update and its version,
+        or a keepalive and the same version if the heartbeat ticks first
+        """
+        while self.version <= version:
+            waiting_for = [self.updated]
+            if heartbeat is not None:
+                waiting_for.append(heartbeat.tick)
+
+            # Unlike awaiting the futures themselves, cancelling this wait leaves them untouched
+            _ = await asyncio.wait(waiting_for, return_when=asyncio.FIRST_COMPLETED)
+            if self.version <= version:
+                return version, KEEPALIVE_FRAME
+        return self.version, self.frame
+
 
 class SSEManager:
     """
@@ -16,12 +92,21 @@ class SSEManager:
 
     Key ideas:
     - Single shared Valkey pub/sub connection for all poll subscriptions
+    - Each update is encoded once into an SSE frame,
+        and the same bytes are handed to every client of the poll
     - Dynamically (un-)subscribes to topics based on active clients
-    - Each client gets an asyncio.Queue with maxsize=1,
+    - Each poll has a PollSlot with its latest update and version, publishing
+        is O(1) regardless of the number of clients. Clients only keep a version,
         i.e. only latest updates get sent all the way in case of contention
     - Automatically cleans up subscriptions when last client disconnects
-    - Configurable connection limits globally and per user
-        (TODO: connection limit handling for anonymous users)
+    - Idle clients are sent keepalives on a single heartbeat shared by all streams
+    - Configurable connection limits globally and per user, checked against
+        maintained counters (TODO: connection limit handling for anonymous users)
+    - Client state is per poll, and only changed synchronously (no awaits),
+        so admitting and removing clients needs no lock
+    - Valkey (un-)subscriptions are made afterwards, outside of that.
+        Polls whose clients came or went while waiting for the pubsub connection
+        are (un-)subscribed together, in a single command
     """
 
     def __init__(
@@ -29,21 +114,24 @@ class SSEManager:
         valkey_conn_str: str,
         max_connections_per_user: int = 5,
         max_connections_total: int = 1000,
+        heartbeat_interval: float = 15.0,
     ):
         self.valkey_conn_str = valkey_conn_str
         self.max_connections_per_user = max_connections_per_user
         self.max_connections_total = max_connections_total
 
-        self.lock = (
-            asyncio.Lock()
-        )  # For exclusively reading and writing to the state structures
-        self.clients: dict[
-            int, set[tuple[int | None, asyncio.Queue[PollUpdateEvent]]]
-        ] = defaultdict(set)
+        self.slots: dict[int, PollSlot] = {}
+        self.total_connections = 0
         self.user_connection_counts: dict[int | None, int] = defaultdict(
             int
         )  # Defaults to 0
+
+        # Polls subscribed to in Valkey, follows self.slots
         self.subscribed_polls: set[int] = set()
+        # Polls that got their first or lost their last client since the last sync
+        self.changed_polls: set[int] = set()
+        self.pubsub_lock = asyncio.Lock()  # Commands on the pubsub connection
+        self.connection_lock = asyncio.Lock()
 
         self.valkey_client: Valkey | None = None
         self.pubsub: PubSub | None = None
@@ -51,8 +139,14 @@ class SSEManager:
 
         self.listener_task: asyncio.Task[None] | None = None
 
+        self.heartbeat = Heartbeat(heartbeat_interval)
+        self.heartbeat_task: asyncio.Task[None] | None = None
+
     async def _ensure_connection(self):
-        if self.valkey_client is None:
+        async with self.connection_lock:
+            if self.valkey_client is not None:
+                return
+
             logger.info("Creating dedicated Valkey client for pubsub")
             self.valkey_client = Valkey.from_url(self.valkey_conn_str)
             self.pubsub = self.valkey_client.pubsub()
@@ -62,89 +156,122 @@ class SSEManager:
 
             self.ready = True
 
-    async def subscribe(
-        self, poll_id: int, user_id: int | None
-    ) -> asyncio.Queue[PollUpdateEvent]:
+    async def subscribe(self, poll_id: int, user_id: int | None) -> PollSlot:
         """
         Subscribe to poll updates
-        Returns a queue that will receive PollUpdateEvent-s
+        Returns the slot of the poll, to wait for updates as encoded SSE frames
 
         Raises:
             RuntimeError: If connection limits are exceeded
         """
-        # only keep the latest update
-        client_queue: asyncio.Queue[PollUpdateEvent] = asyncio.Queue(maxsize=1)
-
-        async with self.lock:
+        if not self.ready:
             await self._ensure_connection()
 
-            # Check global connection limit
-            total_connections = sum(len(clients) for clients in self.clients.values())
-            if total_connections >= self.max_connections_total:
-                raise RuntimeError(
-                    f"Global SSE connection limit reached ({self.max_connections_total})"
-                )
-
-            # Check per-user connection limit
-            if (
-                user_id is not None
-                and self.user_connection_counts[user_id]
-                >= self.max_connections_per_user
-            ):
-                raise RuntimeError(
-                    f"User SSE connection limit reached ({self.max_connections_per_user})"
-                )
-
-            self.clients[poll_id].add((user_id, client_queue))
-            self.user_connection_counts[user_id] += 1
-
-            # If this is the first client for this poll, subscribe to the topic
-            if poll_id not in self.subscribed_polls:
-                topic = poll_update_topic(poll_id)
-                await self.pubsub.subscribe(topic)
-                self.subscribed_polls.add(poll_id)
-                logger.info(f"Subscribed to Redis topic: {topic}")
-
-                # Start the listener task if this is the very first subscription
-                # TODO: this might be safe to move
-                if self.listener_task is None:
-                    self.listener_task = asyncio.create_task(
-                        self._listen_to_all_polls()
-                    )
-                    logger.info("Listener task started")
+        # Check global connection limit
+        if self.total_connections >= self.max_connections_total:
+            raise RuntimeError(
+                f"Global SSE connection limit reached ({self.max_connections_total})"
+            )
+
+        # Check per-user connection limit
+        if (
+            user_id is not None
+            and self.user_connection_counts[user_id] >= self.max_connections_per_user
+        ):
+            raise RuntimeError(
+                f"User SSE connection limit reached ({self.max_connections_per_user})"
+            )
+
+        self.total_connections += 1
+        self.user_connection_counts[user_id] += 1
+        slot = self.slots.get(poll_id)
+        if slot is None:
+            slot = self.slots[poll_id] = PollSlot()
+            self.changed_polls.add(poll_id)
+        slot.subscribers += 1
+
+        # If this is the first client for this poll, subscribe to the topic
+        if poll_id not in self.subscribed_polls:
+            try:
+                await self._sync_subscriptions()
+            except BaseException:
+                await self.unsubscribe(poll_id, user_id)
+                raise
+
+        # Start the listener task if this is the very first subscription
+        if self.listener_task is None:
+            self.listener_task = asyncio.create_task(self._listen_to_all_polls())
+            logger.info("Listener task started")
+
+        if self.heartbeat_task is None:
+            self.heartbeat_task = asyncio.create_task(self.heartbeat.run())
 
         logger.info(
-            f"User {user_id} subscribed to poll {poll_id} (total clients: {len(self.clients[poll_id])})"
+            f"User {user_id} subscribed to poll {poll_id} (total clients: {slot.subscribers})"
         )
-        return client_queue
+        return slot
 
-    async def unsubscribe(
-        self,
-        poll_id: int,
-        user_id: int | None,
-        client_queue: asyncio.Queue[PollUpdateEvent],
-    ):
-        async with self.lock:
-            if poll_id in self.clients:
-                # Remove the (user_id, queue) tuple
-                self.clients[poll_id].discard((user_id, client_queue))
-                self.user_connection_counts[user_id] -= 1
-
-                # Clean up user count if it reaches zero
-                if self.user_connection_counts[user_id] <= 0:
-                    del self.user_connection_counts[user_id]
-
-                # If no more clients for this poll, unsubscribe from the topic
-                if not self.clients[poll_id]:
-                    if poll_id in self.subscribed_polls:
-                        topic = poll_update_topic(poll_id)
-                        await self.pubsub.unsubscribe(topic)
-                        self.subscribed_polls.discard(poll_id)
-                        logger.info(f"Unsubscribed from Redis topic: {topic}")
-                    del self.clients[poll_id]
+    async def unsubscribe(self, poll_id: int, user_id: int | None):
+        slot = self.slots.get(poll_id)
+        if slot is None:
+            return
+
+        slot.subscribers -= 1
+        self.total_connections -= 1
+        self.user_connection_counts[user_id] -= 1
+
+        # Clean up user count if it reaches zero
+        if self.user_connection_counts[user_id] <= 0:
+            del self.user_connection_counts[user_id]
+
+        # If no more clients for this poll, unsubscribe from the topic.
+        # Shielded, as the client's task is usually being cancelled when it disconnects
+        if slot.subscribers <= 0:
+            del self.slots[poll_id]
+            self.changed_polls.add(poll_id)
+            await asyncio.shield(self._sync_subscriptions())
 
         logger.debug(f"User {user_id} unsubscribed from poll {poll_id}")
 
+    async def _sync_subscriptions(self):
+        """
+        (Un-)subscribe to the topics of changed polls, depending on whether they
+        have clients now. Clients might come and go while waiting for the lock,
+        so the changes are only collected once it is held
+        """
+        async with self.pubsub_lock:
+            changed_polls, self.changed_polls = self.changed_polls, set()
+            subscribe = {
+                p
+                for p in changed_polls
+                if p in self.slots and p not in self.subscribed_polls
+            }
+            unsubscribe = {
+                p
+                for p in changed_polls
+                if p not in self.slots and p in self.subscribed_polls
+            }
+
+            try:
+                if subscribe:
+                    await self.pubsub.subscribe(
+                        *(poll_update_topic(p) for p in subscribe)
+                    )
+                    self.subscribed_polls |= subscribe
+                    logger.info(f"Subscribed to the topics of {len(subscribe)} poll(s)")
+                if unsubscribe:
+                    await self.pubsub.unsubscribe(
+                        *(poll_update_topic(p) for p in unsubscribe)
+                    )
+                    self.subscribed_polls -= unsubscribe
+                    logger.info(
+                        f"Unsubscribed from the topics of {len(unsubscribe)} poll(s)"
+                    )
+            except BaseException:
+                # Retried by the next sync
+                self.changed_polls |= changed_polls
+                raise
+
     async def _listen_to_all_polls(self):
         """Background task that listens to all subscribed polls on a single connection"""
         if not self.pubsub:
@@ -155,10 +282,7 @@ class SSEManager:
             logger.info("Starting pubsub listener for all polls")
 
             while True:
-                async with self.lock:
-                    has_subscriptions = len(self.subscribed_polls) > 0
-
-                if not has_subscriptions:
+                if not self.subscribed_polls:
                     # No active subscriptions, do not get_message (this would fail)
                     await asyncio.sleep(0.5)
                     continue
@@ -185,7 +309,8 @@ class SSEManager:
                         logger.debug(
                             f"Parsed event for poll {event.poll_id} with {len(event.vote_counts)} vote counts"
                         )
-                        await self._broadcast_to_clients(event.poll_id, event)
+                        frame = vote_update_frame(event.vote_counts)
+                        self._broadcast_to_clients(event.poll_id, frame)
                     except Exception as e:
                         logger.error(f"Error processing message: {e}", exc_info=True)
                 elif message["type"] == "subscribe":
@@ -202,47 +327,21 @@ class SSEManager:
         except Exception as e:
             logger.error(f"Error in pubsub listener task: {e}", exc_info=True)
 
-    async def _broadcast_to_clients(self, poll_id: int, event: PollUpdateEvent):
+    def _broadcast_to_clients(self, poll_id: int, frame: bytes):
         """Broadcast an update to all clients subscribed to a poll"""
-        async with self.lock:
-            clients = self.clients.get(poll_id, set()).copy()
-
-        if not clients:
+        slot = self.slots.get(poll_id)
+        if slot is None:
             logger.debug(f"No clients connected for poll {poll_id}, skipping broadcast")
             return
 
-        logger.debug(f"Broadcasting to {len(clients)} client(s) for poll {poll_id}")
-
-        dead_clients = []
-        for user_id, client_queue in clients:
-            try:
-                # If there's an unpopped event in the queue, just replace it.
-                # The client only wants the most recent data anyway
-                if client_queue.full():
-                    try:
-                        client_queue.get_nowait()
-                    except asyncio.QueueEmpty:
-                        pass
-
-                client_queue.put_nowait(event)
-            except Exception as e:
-                logger.warning(f"Failed to send to client for poll {poll_id}: {e}")
-                dead_clients.append((user_id, client_queue))
-
-        # Clean up dead clients
-        if dead_clients:
-            async with self.lock:
-                for user_id, dead_client in dead_clients:
-                    self.clients[poll_id].discard((user_id, dead_client))
-                    self.user_connection_counts[user_id] -= 1
-                    if self.user_connection_counts[user_id] <= 0:
-                        del self.user_connection_counts[user_id]
+        logger.debug(f"Broadcasting to {slot.subscribers} client(s) for poll {poll_id}")
+        slot.publish(frame)
 
     async def shutdown(self):
         """Shutdown all subscriptions and clean up resources"""
         logger.info("Shutting down SSE Manager")
 
-        async with self.lock:
+        async with self.connection_lock:
             # Cancel listener task
             if self.listener_task:
                 self.listener_task.cancel()
@@ -252,6 +351,11 @@ class SSEManager:
                     pass
                 self.listener_task = None
 
+            if self.heartbeat_task:
+                _ = self.heartbeat_task.cancel()
+                _ = await asyncio.gather(self.heartbeat_task, return_exceptions=True)
+                self.heartbeat_task = None
+
             # Unsubscribe from all topics
             if self.pubsub:
                 for poll_id in list(self.subscribed_polls):
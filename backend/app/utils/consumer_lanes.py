@@ -0,0 +1,170 @@
+import asyncio
+import logging
+from collections import deque
+from collections.abc import Awaitable, Callable
+
+from aiokafka import ConsumerRecord, TopicPartition
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+from valkey.asyncio import ConnectionPool, Valkey
+
+from app.db.kafka import VoteEvent
+
+logger = logging.getLogger(__name__)
+
+ProcessVotes = Callable[
+    [list[tuple[int, VoteEvent]], AsyncConnection, Valkey], Awaitable[None]
+]
+
+
+class PartitionOffsets:
+    """
+    Tracks the messages of a partition that are being processed,
+    to find the offset that can safely be committed
+    """
+
+    def __init__(self):
+        self.in_flight: deque[int] = deque()
+        self.done: set[int] = set()
+        self.committable: int | None = None  # Offset of the next message to consume
+
+    def add(self, offset: int):
+        self.in_flight.append(offset)
+
+    def mark_done(self, offset: int):
+        self.done.add(offset)
+
+        # Only move past messages once everything before them is processed too
+        while self.in_flight and self.in_flight[0] in self.done:
+            self.done.remove(self.in_flight[0])
+            self.committable = self.in_flight.popleft() + 1
+
+
+class ConsumerLanes:
+    """
+    Processes vote events concurrently on a fixed number of lanes.
+
+    Key ideas:
+    - Messages are hashed to a lane by their key (poll_id),
+        so votes on the same poll are processed in order
+    - Each lane has its own DB connection and Valkey client,
+        and processes whatever is queued up for it as a single batch
+    - Offsets of a partition only become committable up to
+        the lowest message that is not yet fully processed
+    - A failed lane stops processing, and the failure is raised from check().
+        This includes failing to connect, e.g. when the database is restarting
+    """
+
+    def __init__(
+        self,
+        num_lanes: int,
+        max_batch_size: int,
+        db_engine: AsyncEngine,
+        valkey_pool: ConnectionPool,
+        process_votes: ProcessVotes,
+    ):
+        self.max_batch_size = max_batch_size
+        self.db_engine = db_engine
+        self.valkey_pool = valkey_pool
+        self.process_votes = process_votes
+
+        self.queues: list[asyncio.Queue[ConsumerRecord[int, VoteEvent]]] = [
+            asyncio.Queue(maxsize=max_batch_size) for _ in range(num_lanes)
+        ]
+        self.offsets: dict[TopicPartition, PartitionOffsets] = {}
+        self.committed: dict[TopicPartition, int] = {}
+        self.error: BaseException | None = None
+
+        self.lane_tasks: list[asyncio.Task[None]] = []
+
+    def start(self):
+        self.lane_tasks = [
+            asyncio.create_task(self._run_lane(queue)) for queue in self.queues
+        ]
+
+    async def submit(self, msg: ConsumerRecord[int, VoteEvent]):
+        """Queue a message on its lane, waits if the lane is full"""
+        tp = TopicPartition(msg.topic, msg.partition)
+        self.offsets.setdefault(tp, PartitionOffsets()).add(msg.offset)
+        await self.queues[hash(msg.key) % len(self.queues)].put(msg)
+
+    def check(self):
+        """Raise the error of a failed lane, if any"""
+        if self.error is not None:
+            raise self.error
+
+    def committable_offsets(
+        self, assignment: set[TopicPartition]
+    ) -> dict[TopicPartition, int]:
+        """Get the offsets that can be committed, and have not been committed yet"""
+        offsets: dict[TopicPartition, int] = {}
+        for tp in assignment:
+            partition_offsets = self.offsets.get(tp)
+            if partition_offsets is None or partition_offsets.committable is None:
+                continue
+            if self.committed.get(tp) != partition_offsets.committable:
+                offsets[tp] = partition_offsets.committable
+        return offsets
+
+    def mark_committed(self, offsets: dict[TopicPartition, int]):
+        self.committed.update(offsets)
+
+    async def drain(self):
+        """Wait until every queued message has been handled"""
+        for queue in self.queues:
+            await queue.join()
+
+    async def stop(self):
+        for task in self.lane_tasks:
+            _ = task.cancel()
+        _ = await asyncio.gather(*self.lane_tasks, return_exceptions=True)
+        self.lane_tasks = []
+
+    async def _run_lane(self, queue: asyncio.Queue[ConsumerRecord[int, VoteEvent]]):
+        try:
+            async with self.db_engine.connect() as conn, Valkey(
+                connection_pool=self.valkey_pool, single_connection_client=True
+            ) as valkey:
+                while True:
+                    # Everything queued up on the lane is processed as one batch
+                    msgs = [await queue.get()]
+                    while len(msgs) < self.max_batch_size and not queue.empty():
+                        msgs.append(queue.get_nowait())
+
+                    try:
+                        if self.error is None:
+                            await self._process(msgs, conn, valkey)
+                    except Exception as e:
+                        # Offsets of the batch are never marked done, so never committed
+                        logger.error(f"Error processing votes: {e}", exc_info=True)
+                        self.error = e
+                    finally:
+                        for _ in msgs:
+                            queue.task_done()
+        except Exception as e:
+            # E.g. the database or Valkey could not be connected to
+            logger.error(f"Error running consumer lane: {e}", exc_info=True)
+            self.error = e
+
+        # Keep taking messages off the queue without processing them,
+        # so submit() and drain() don't block before the error is noticed
+        while True:
+            _ = await queue.get()
+            queue.task_done()
+
+    async def _process(
+        self,
+        msgs: list[ConsumerRecord[int, VoteEvent]],
+        conn: AsyncConnection,
+        valkey: Valkey,
+    ):
+        try:
+            await self.process_votes([(m.key, m.value) for m in msgs], conn, valkey)
+            # Ends any transaction that was started after the votes were committed
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            raise
+
+        for msg in msgs:
+            tp = TopicPartition(msg.topic, msg.partition)
+            self.offsets[tp].mark_done(msg.offset)
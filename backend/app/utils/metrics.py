@@ -0,0 +1,185 @@
+import asyncio
+import bisect
+import logging
+import math
+import os
+import socket
+from collections.abc import Sequence
+
+from valkey.asyncio import ConnectionPool, Valkey
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 10)
+
+# Every process writes the totals of its samples to its own hash in Valkey.
+# Writes are idempotent, and processes that exited keep their last totals,
+# so the sum over all processes never decreases
+_PROCESSES_KEY = "metrics:processes"
+
+
+def _format_labels(labelnames: Sequence[str], labels: Sequence[str]) -> str:
+    if not labelnames:
+        return ""
+    pairs = ",".join(f'{k}="{v}"' for k, v in zip(labelnames, labels))
+    return f"{{{pairs}}}"
+
+
+class Counter:
+    """Monotonically increasing count, per combination of label values"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple[str, ...], float] = {}
+        REGISTRY.append(self)
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(labels[k] for k in self.labelnames)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> dict[str, float]:
+        """Totals of this process, by sample name"""
+        return {
+            f"{self.name}{_format_labels(self.labelnames, key)}": value
+            for key, value in self.values.items()
+        }
+
+    def render(self, samples: dict[str, float] | None = None) -> list[str]:
+        """Render the given samples, by default those of this process"""
+        if samples is None:
+            samples = self.samples()
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for sample, value in sorted(samples.items()):
+            lines.append(f"{sample} {value}")
+        return lines
+
+
+class Histogram:
+    """Distribution of observed values (e.g. latencies) over fixed buckets"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = (*sorted(buckets), math.inf)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        REGISTRY.append(self)
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def _bucket_samples(self) -> list[str]:
+        return [
+            f'{self.name}_bucket{{le="{"+Inf" if bound == math.inf else bound}"}}'
+            for bound in self.buckets
+        ]
+
+    def samples(self) -> dict[str, float]:
+        """Totals of this process, by sample name"""
+        samples: dict[str, float] = {}
+        cumulative = 0
+        for sample, count in zip(self._bucket_samples(), self.counts):
+            cumulative += count
+            samples[sample] = cumulative
+        samples[f"{self.name}_sum"] = self.sum
+        samples[f"{self.name}_count"] = cumulative
+        return samples
+
+    def render(self, samples: dict[str, float] | None = None) -> list[str]:
+        """Render the given samples, by default those of this process"""
+        if samples is None:
+            samples = self.samples()
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for sample in [
+            *self._bucket_samples(),
+            f"{self.name}_sum",
+            f"{self.name}_count",
+        ]:
+            lines.append(f"{sample} {samples.get(sample, 0)}")
+        return lines
+
+
+REGISTRY: list[Counter | Histogram] = []
+
+
+def _process_key() -> str:
+    # Looked up on every write, as gunicorn may import the app before forking
+    return f"metrics:process:{socket.gethostname()}:{os.getpid()}"
+
+
+async def write_metrics(valkey: Valkey):
+    """Write the totals of every metric of this process to Valkey"""
+    # Metric and sample names never contain a newline
+    fields = {
+        f"{metric.name}\n{sample}": value
+        for metric in REGISTRY
+        for sample, value in metric.samples().items()
+    }
+    if not fields:
+        return
+
+    key = _process_key()
+    async with valkey.pipeline(transaction=False) as pipe:
+        _ = pipe.hset(key, mapping=fields)
+        _ = pipe.sadd(_PROCESSES_KEY, key)
+        _ = await pipe.execute()
+
+
+async def keep_writing_metrics(pool: ConnectionPool, interval: float):
+    """
+    Write the metrics of this process to Valkey every interval, until cancelled.
+    Writes them once more when cancelled, so the last counts aren't lost on shutdown.
+    """
+    async with Valkey(connection_pool=pool) as valkey:
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                try:
+                    await write_metrics(valkey)
+                except Exception as e:
+                    logger.error(f"Error writing metrics to Valkey: {e}")
+        finally:
+            await write_metrics(valkey)
+
+
+async def render_metrics(valkey: Valkey) -> str:
+    """
+    Render all metrics in the Prometheus text format,
+    summed over every API and consumer process writing them to Valkey
+    """
+    await write_metrics(valkey)
+
+    keys: set[bytes] = await valkey.smembers(_PROCESSES_KEY)
+    async with valkey.pipeline(transaction=False) as pipe:
+        for key in keys:
+            _ = pipe.hgetall(key)
+        hashes: list[dict[bytes, bytes]] = await pipe.execute()
+
+    totals: dict[str, dict[str, float]] = {}
+    for fields in hashes:
+        for field, value in fields.items():
+            name, sample = field.decode().split("\n", 1)
+            samples = totals.setdefault(name, {})
+            samples[sample] = samples.get(sample, 0) + float(value)
+
+    lines = [
+        line
+        for metric in REGISTRY
+        for line in metric.render(totals.get(metric.name, {}))
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,72 @@
+from typing import Annotated
+
+from fastapi import Depends, Request
+from valkey.asyncio import ConnectionPool
+
+from app.db.db import DBConnection
+from app.db.sqlc import poll as poll_queries
+from app.utils.metrics import Counter
+from app.utils.tiered_cache import TieredPollCache
+
+POLL_DOCUMENT_INVALIDATION_TOPIC = "poll-document-invalidations"
+
+_lookups = Counter(
+    "poll_document_cache_lookups_total",
+    "Poll document lookups, by the tier that answered them",
+    labelnames=["result"],
+)
+
+
+class PollWithUserVote(poll_queries.GetPollDocumentRow):
+    """A poll as shown to a user, with the vote option they voted for"""
+
+    user_vote: int | None
+
+
+def with_user_vote(document: bytes, user_vote: int | None) -> bytes:
+    """
+    Adds the vote of the current user to a poll document, giving a PollWithUserVote.
+    The document is a JSON object, so the field is spliced in without parsing it
+    """
+    vote = b"null" if user_vote is None else str(user_vote).encode()
+    return document[:-1] + b',"user_vote":' + vote + b"}"
+
+
+class TieredPollDocumentCache(TieredPollCache[bytes]):
+    """
+    Caches polls as they are shown to every user (question, options and creator),
+    already serialized to JSON, so viewing a poll does not need the aggregate query.
+    Documents are the same for every user, the vote of the user is added afterwards.
+    Does not check if the user may view the poll.
+    """
+
+    def __init__(self, valkey_pool: ConnectionPool, max_size: int, ttl: float):
+        super().__init__(
+            valkey_pool,
+            name="document",
+            topic=POLL_DOCUMENT_INVALIDATION_TOPIC,
+            max_size=max_size,
+            ttl=ttl,
+            lookups=_lookups,
+        )
+
+    async def load(self, conn: DBConnection, poll_id: int) -> bytes | None:
+        q = poll_queries.AsyncQuerier(conn)
+        poll = await q.get_poll_document(id=poll_id)
+        return poll.model_dump_json().encode() if poll is not None else None
+
+    def encode(self, value: bytes) -> bytes:
+        return value
+
+    def decode(self, data: bytes) -> bytes:
+        return data
+
+
+def _get_poll_document_cache(request: Request) -> TieredPollDocumentCache:
+    return request.app.state.poll_document_cache
+
+
+# Injectable dependency for our routes
+PollDocumentCache = Annotated[
+    TieredPollDocumentCache, Depends(_get_poll_document_cache)
+]
@@ -0,0 +1,57 @@
+from typing import Annotated
+
+from fastapi import Depends, Request
+from valkey.asyncio import ConnectionPool
+
+from app.db.db import DBConnection
+from app.db.sqlc import poll as poll_queries
+from app.utils.metrics import Counter
+from app.utils.tiered_cache import TieredPollCache
+
+POLL_METADATA_INVALIDATION_TOPIC = "poll-metadata-invalidations"
+
+_lookups = Counter(
+    "poll_metadata_cache_lookups_total",
+    "Poll metadata lookups, by the tier that answered them",
+    labelnames=["result"],
+)
+
+PollMetadata = poll_queries.GetPollMetadataRow
+
+
+class TieredPollMetadataCache(TieredPollCache[PollMetadata]):
+    """
+    Caches the metadata of polls (expiry, creator and vote option ids),
+    in memory and in Valkey, for checking votes without the database
+    """
+
+    def __init__(self, valkey_pool: ConnectionPool, max_size: int, ttl: float):
+        super().__init__(
+            valkey_pool,
+            # Stored as JSON, a hash in Valkey before
+            name="metadata:json",
+            topic=POLL_METADATA_INVALIDATION_TOPIC,
+            max_size=max_size,
+            ttl=ttl,
+            lookups=_lookups,
+        )
+
+    async def load(self, conn: DBConnection, poll_id: int) -> PollMetadata | None:
+        q = poll_queries.AsyncQuerier(conn)
+        return await q.get_poll_metadata(id=poll_id)
+
+    def encode(self, value: PollMetadata) -> bytes:
+        return value.model_dump_json().encode()
+
+    def decode(self, data: bytes) -> PollMetadata:
+        return PollMetadata.model_validate_json(data)
+
+
+def _get_poll_metadata_cache(request: Request) -> TieredPollMetadataCache:
+    return request.app.state.poll_metadata_cache
+
+
+# Injectable dependency for our routes
+PollMetadataCache = Annotated[
+    TieredPollMetadataCache, Depends(_get_poll_metadata_cache)
+]
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+
+from valkey.asyncio import Valkey
+
+from app.db.sqlc import vote as vote_queries
+from app.db.valkey import publish_poll_update
+
+logger = logging.getLogger(__name__)
+
+
+class PollUpdatePublisher:
+    """
+    Coalesces poll updates, so that at most one PollUpdateEvent
+    is published per poll per interval.
+
+    Key ideas:
+    - A poll that has been quiet for the interval is published immediately
+    - Otherwise the update is held back, and published once the interval has passed
+    - Held back updates are replaced by newer ones,
+        so the final state of a poll is never lost
+    - A poll stays throttled until its held back update has been published,
+        and the interval only starts once it is, so updates are published in order
+    """
+
+    def __init__(self, valkey: Valkey, interval: float):
+        self.valkey = valkey
+        self.interval = interval
+
+        self.throttled_polls: set[int] = set()  # Published within the last interval
+        self.pending_updates: dict[int, list[vote_queries.GetVoteCountsRow]] = {}
+        self.publish_tasks: set[asyncio.Task[None]] = set()
+
+    async def update(
+        self, poll_id: int, vote_counts: list[vote_queries.GetVoteCountsRow]
+    ):
+        """Notify the publisher of the latest vote counts of a poll"""
+        if poll_id in self.throttled_polls:
+            self.pending_updates[poll_id] = vote_counts
+            return
+
+        await self._publish(poll_id, vote_counts)
+
+    async def _publish(
+        self, poll_id: int, vote_counts: list[vote_queries.GetVoteCountsRow]
+    ):
+        self.throttled_polls.add(poll_id)
+        try:
+            await publish_poll_update(self.valkey, poll_id, vote_counts)
+        finally:
+            asyncio.get_running_loop().call_later(
+                self.interval, self._on_interval_passed, poll_id
+            )
+
+    def _on_interval_passed(self, poll_id: int):
+        vote_counts = self.pending_updates.pop(poll_id, None)
+        if vote_counts is None:
+            self.throttled_polls.discard(poll_id)
+            return
+
+        # Flush the update that was held back. The poll stays throttled meanwhile,
+        # so newer updates are held back until after it, instead of overtaking it
+        task = asyncio.create_task(self._publish_in_background(poll_id, vote_counts))
+        self.publish_tasks.add(task)
+        task.add_done_callback(self.publish_tasks.discard)
+
+    async def _publish_in_background(
+        self, poll_id: int, vote_counts: list[vote_queries.GetVoteCountsRow]
+    ):
+        try:
+            await self._publish(poll_id, vote_counts)
+        except Exception as e:
+            logger.error(f"Error publishing update for poll {poll_id}: {e}")
+
+    async def flush(self):
+        """Publish all held back updates immediately, e.g. before shutting down"""
+        # Updates being flushed in the background are older than the held back ones
+        if self.publish_tasks:
+            _ = await asyncio.gather(*self.publish_tasks, return_exceptions=True)
+
+        pending_updates = self.pending_updates
+        self.pending_updates = {}
+        for poll_id, vote_counts in pending_updates.items():
+            await self._publish(poll_id, vote_counts)
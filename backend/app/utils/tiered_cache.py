@@ -0,0 +1,156 @@
+import asyncio
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+
+from valkey.asyncio import ConnectionPool
+
+from app.db.db import DBConnection
+from app.db.valkey import ValkeyConnection, listen_to_topic
+from app.utils.metrics import Counter
+
+# Left in Valkey in place of a deleted poll. Never a valid value, as those aren't empty
+_TOMBSTONE = b""
+# Must outlast loading a value from the database and caching it
+_TOMBSTONE_TTL_S = 60
+
+
+class TieredPollCache[T](ABC):
+    """
+    Caches a value per poll that does not change from creating a poll until deleting it.
+    Subclasses load the value from the database, and (de)serialize it for Valkey.
+
+    Key ideas:
+    - An in-memory LRU tier per process, backed by a Valkey tier shared by all
+    - Both tiers expire entries after a TTL, which bounds how long
+        a deleted poll can linger, e.g. when an invalidation is missed
+    - Deleting a poll replaces it in Valkey with a short-lived tombstone, and publishes
+        an invalidation for the in-memory tier of every process
+    - Values are only added to Valkey if the key does not exist, so a value loaded
+        just before a deletion committed can't overwrite the tombstone
+    - Polls that do not exist are not cached, as they could be created later
+    """
+
+    def __init__(
+        self,
+        valkey_pool: ConnectionPool,
+        name: str,
+        topic: str,
+        max_size: int,
+        ttl: float,
+        lookups: Counter,
+    ):
+        self.valkey_pool = valkey_pool
+        self.name = name
+        self.topic = topic
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lookups = lookups
+
+        # Value and its expiry (monotonic clock), in least recently used order
+        self.entries: OrderedDict[int, tuple[T, float]] = OrderedDict()
+        # Bumped on every invalidation, to detect it during a lookup
+        self.generation = 0
+
+        self.listener_task: asyncio.Task[None] | None = None
+
+    @abstractmethod
+    async def load(self, conn: DBConnection, poll_id: int) -> T | None:
+        """Load the value of a poll from the database, None if it does not exist"""
+
+    @abstractmethod
+    def encode(self, value: T) -> bytes: ...
+
+    @abstractmethod
+    def decode(self, data: bytes) -> T: ...
+
+    def key(self, poll_id: int) -> str:
+        return f"poll:{poll_id}:{self.name}"
+
+    def start(self):
+        self.listener_task = asyncio.create_task(
+            listen_to_topic(
+                self.valkey_pool,
+                self.topic,
+                on_message=lambda message: self.invalidate(int(message)),
+                on_subscribed=self.invalidate,
+            )
+        )
+
+    async def stop(self):
+        if self.listener_task is not None:
+            _ = self.listener_task.cancel()
+            _ = await asyncio.gather(self.listener_task, return_exceptions=True)
+            self.listener_task = None
+
+    async def get_cached(self, valkey: ValkeyConnection, poll_id: int) -> T | None:
+        """Get the value of a poll if it is cached, without touching the database"""
+        entry = self.entries.get(poll_id)
+        if entry is not None:
+            value, expires_at = entry
+            if time.monotonic() < expires_at:
+                self.entries.move_to_end(poll_id)
+                self.lookups.inc(result="memory_hit")
+                return value
+            del self.entries[poll_id]
+
+        generation = self.generation
+        data: bytes | None = await valkey.get(self.key(poll_id))
+        if data is None or data == _TOMBSTONE:
+            self.lookups.inc(result="miss")
+            return None
+
+        self.lookups.inc(result="valkey_hit")
+        value = self.decode(data)
+        if generation == self.generation:
+            self._remember(poll_id, value)
+        return value
+
+    async def get(
+        self, conn: DBConnection, valkey: ValkeyConnection, poll_id: int
+    ) -> T | None:
+        """
+        Get the value of a poll, loading it from the database on a miss.
+        Returns None if the poll does not exist.
+        """
+        value = await self.get_cached(valkey, poll_id)
+        if value is not None:
+            return value
+
+        generation = self.generation
+        value = await self.load(conn, poll_id)
+        if value is not None and generation == self.generation:
+            await self.put(valkey, poll_id, value)
+        return value
+
+    async def put(self, valkey: ValkeyConnection, poll_id: int, value: T):
+        """Cache the value of a poll, e.g. right after creating it"""
+        stored = await valkey.set(
+            self.key(poll_id), self.encode(value), ex=int(self.ttl), nx=True
+        )
+        # Not stored if it's already cached, or if the poll has been deleted since
+        if stored:
+            self._remember(poll_id, value)
+
+    def invalidate(self, poll_id: int | None = None):
+        """Forget the value of a poll, or of every poll if none is given"""
+        self.generation += 1
+        if poll_id is None:
+            self.entries.clear()
+        else:
+            _ = self.entries.pop(poll_id, None)
+
+    async def publish_invalidation(self, valkey: ValkeyConnection, poll_id: int):
+        """
+        Forget the value of a poll in every process, after deleting it.
+        The deletion must already be committed.
+        """
+        self.invalidate(poll_id)
+        _ = await valkey.set(self.key(poll_id), _TOMBSTONE, ex=_TOMBSTONE_TTL_S)
+        _ = await valkey.publish(self.topic, str(poll_id))
+
+    def _remember(self, poll_id: int, value: T):
+        self.entries[poll_id] = (value, time.monotonic() + self.ttl)
+        self.entries.move_to_end(poll_id)
+        if len(self.entries) > self.max_size:
+            _ = self.entries.popitem(last=False)
@@ -1,28 +1,98 @@
 import asyncio
+import hashlib
+import secrets
+from collections import OrderedDict
 from contextlib import asynccontextmanager
 
+from valkey.exceptions import NoScriptError
+
 from app.db.db import DBConnection
 from app.db.sqlc import vote as vote_queries
-from app.db.valkey import ValkeyConnection
+from app.db.valkey import ValkeyConnection, poll_update_topic
+
+# Applies vote count deltas to a vote table, and returns the resulting counts.
+# Optionally publishes them as a PollUpdateEvent, all in one atomic step.
+# Returns nil without changing anything if the vote table does not exist.
+#   KEYS[1]: vote table key
+#   ARGV[1]: poll id
+#   ARGV[2]: topic to publish the PollUpdateEvent to, empty to not publish
+#   ARGV[3...]: pairs of vote option id and count delta
+_APPLY_VOTE_DELTAS_LUA = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return false
+end
+
+for i = 3, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+
+local counts = redis.call('HGETALL', KEYS[1])
+
+if ARGV[2] ~= '' then
+    local vote_counts = {}
+    for i = 1, #counts, 2 do
+        vote_counts[#vote_counts + 1] = {
+            vote_option_id = tonumber(counts[i]),
+            vote_count = tonumber(counts[i + 1]),
+        }
+    end
+    redis.call('PUBLISH', ARGV[2], cjson.encode({
+        poll_id = tonumber(ARGV[1]),
+        vote_counts = vote_counts,
+    }))
+end
+
+return counts
+"""
+_APPLY_VOTE_DELTAS_SHA = hashlib.sha1(_APPLY_VOTE_DELTAS_LUA.encode()).hexdigest()
+
+
+# Deletes a lock, but only if it is still held by the given token
+#   KEYS[1]: lock key
+#   ARGV[1]: lock token
+_RELEASE_LOCK_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# How long a vote table lock is held at most, e.g. if its holder crashes
+_LOCK_TTL_MS = 10_000
+# How long to wait before trying to take a vote table lock again, when rebuilding
+_LOCK_RETRY_S = 0.01
+
+# Vote tables known to exist in Valkey (in least recently used order),
+# and in-progress loads, for this process
+_MAX_WARM_VOTE_TABLES = 100_000
+_warm_vote_tables: OrderedDict[int, None] = OrderedDict()
+_loading_vote_tables: dict[int, asyncio.Future[None]] = {}
 
 
 @asynccontextmanager
-async def acquire_valkey_lock(valkey: ValkeyConnection, lock_key: str):
-    # Atomically sets lock only if it is not already set
-    acquired = await valkey.set(lock_key, "locked", nx=True)
+async def acquire_valkey_lock(valkey: ValkeyConnection, lock_key: str, ttl_ms: int):
+    # Atomically sets lock only if it is not already set, with an unique token
+    token = secrets.token_hex(16)
+    acquired = await valkey.set(lock_key, token, nx=True, px=ttl_ms)
     try:
-        if acquired:
-            yield True
-        else:
-            yield False
+        yield bool(acquired)
     finally:
-        await valkey.delete(lock_key)
+        if acquired:
+            _ = await valkey.eval(_RELEASE_LOCK_LUA, 1, lock_key, token)
 
 
 def vote_table_key(poll_id: int) -> str:
     return f"poll:{poll_id}:votes"
 
 
+def forget_valkey_vote_table(poll_id: int):
+    """
+    Forget that a vote table is known to exist,
+    e.g. if it has been found missing from Valkey
+    """
+    _ = _warm_vote_tables.pop(poll_id, None)
+
+
 async def ensure_valkey_vote_table(
     poll_id: int, conn: DBConnection, valkey: ValkeyConnection
 ):
@@ -30,34 +100,201 @@ async def ensure_valkey_vote_table(
     Atomically ensure a vote counts table exists in Valkey.
     If it does not exist, it will be created exactly once by reading from the database.
     All other callers of this function wait until the count is finished.
+
+    Tables that are known to exist are remembered, so this is free for warm polls.
+    Only the most recently used ones are remembered, polls get deleted eventually.
+    Concurrent callers in the same process share a single load.
+    """
+    if poll_id in _warm_vote_tables:
+        _warm_vote_tables.move_to_end(poll_id)
+        return
+
+    while poll_id not in _warm_vote_tables:
+        loading = _loading_vote_tables.get(poll_id)
+        if loading is not None:
+            # Don't cancel the shared load if this caller gets cancelled
+            await asyncio.shield(loading)
+            continue
+
+        loading = asyncio.get_running_loop().create_future()
+        _loading_vote_tables[poll_id] = loading
+        try:
+            await _load_valkey_vote_table(poll_id, conn, valkey)
+            _remember_vote_table(poll_id)
+        finally:
+            # On failure, the waiters retry the load themselves
+            del _loading_vote_tables[poll_id]
+            loading.set_result(None)
+
+
+def _remember_vote_table(poll_id: int):
+    _warm_vote_tables[poll_id] = None
+    _warm_vote_tables.move_to_end(poll_id)
+    if len(_warm_vote_tables) > _MAX_WARM_VOTE_TABLES:
+        _ = _warm_vote_tables.popitem(last=False)
+
+
+async def _load_valkey_vote_table(
+    poll_id: int, conn: DBConnection, valkey: ValkeyConnection
+):
+    """
+    Create a vote counts table, unless another process already did.
+    When another process is creating it, block until it signals the table is ready.
     """
     table_key = vote_table_key(poll_id)
     lock_key = f"{table_key}:lock"
+    ready_key = f"{table_key}:ready"
 
     if await valkey.exists(table_key):
         return
 
     while True:
-        async with acquire_valkey_lock(valkey, lock_key) as acquired:
-            if not acquired:
-                # Wait and check if created successfully
-                await asyncio.sleep(0.5)
+        async with acquire_valkey_lock(valkey, lock_key, _LOCK_TTL_MS) as acquired:
+            if acquired:
                 if await valkey.exists(table_key):
                     return
 
-                continue
+                await _write_valkey_vote_table(poll_id, conn, valkey)
+                return
+
+        # Block until the ready signal is pushed. Moving it back onto the same list
+        # keeps it in place, so every waiter gets woken up, not just the first one
+        ready = await valkey.blmove(
+            ready_key, ready_key, _LOCK_TTL_MS / 1000, src="LEFT", dest="RIGHT"
+        )
+        if ready is not None:
+            return
+
+        # The lock holder did not finish in time, try to load the table again
 
-            # Lock acquired
-            if await valkey.exists(table_key):
+
+async def _write_valkey_vote_table(
+    poll_id: int, conn: DBConnection, valkey: ValkeyConnection
+):
+    """
+    (Re)create a vote counts table from the database, replacing it if it exists,
+    and signal waiters that it is ready. The lock of the table must be held.
+    """
+    table_key = vote_table_key(poll_id)
+    ready_key = f"{table_key}:ready"
+
+    q = vote_queries.AsyncQuerier(conn)
+    vote_counts = {
+        x.vote_option_id: x.vote_count async for x in q.get_vote_counts(id=poll_id)
+    }
+    pipe = valkey.pipeline()
+    pipe.delete(table_key)
+    if vote_counts:
+        pipe.hset(table_key, mapping=vote_counts)
+    pipe.delete(ready_key)
+    pipe.rpush(ready_key, 1)
+    pipe.pexpire(ready_key, _LOCK_TTL_MS)
+    _ = await pipe.execute()
+
+
+async def _rebuild_valkey_vote_table(
+    poll_id: int, conn: DBConnection, valkey: ValkeyConnection
+):
+    """
+    Recreate a vote counts table from the database, even if another process
+    is loading it right now: that load might have read the database
+    before the caller's changes were committed, and would miss them.
+    """
+    lock_key = f"{vote_table_key(poll_id)}:lock"
+    while True:
+        async with acquire_valkey_lock(valkey, lock_key, _LOCK_TTL_MS) as acquired:
+            if acquired:
+                await _write_valkey_vote_table(poll_id, conn, valkey)
+                _remember_vote_table(poll_id)
                 return
 
-            # Create vote table
-            q = vote_queries.AsyncQuerier(conn)
-            _ = await valkey.hset(
-                table_key,
-                mapping={
-                    x.vote_option_id: x.vote_count
-                    async for x in q.get_vote_counts(id=poll_id)
-                },
+        # Wait for the other load to finish, and then overwrite it
+        await asyncio.sleep(_LOCK_RETRY_S)
+
+
+async def get_valkey_vote_counts(
+    poll_id: int, conn: DBConnection, valkey: ValkeyConnection
+) -> list[vote_queries.GetVoteCountsRow]:
+    """
+    Get the materialized vote counts of a poll from Valkey,
+    creating the vote counts table if it does not exist.
+    """
+    await ensure_valkey_vote_table(poll_id, conn, valkey)
+    vote_counts: dict[bytes, bytes] = await valkey.hgetall(vote_table_key(poll_id))
+    if not vote_counts:
+        # The table was lost, e.g. because Valkey got flushed
+        forget_valkey_vote_table(poll_id)
+        await ensure_valkey_vote_table(poll_id, conn, valkey)
+        vote_counts = await valkey.hgetall(vote_table_key(poll_id))
+
+    return [
+        vote_queries.GetVoteCountsRow(vote_option_id=k, vote_count=v)
+        for k, v in vote_counts.items()
+    ]
+
+
+async def apply_vote_deltas(
+    valkey: ValkeyConnection,
+    conn: DBConnection,
+    deltas: dict[int, dict[int, int]],
+    publish: bool = False,
+) -> dict[int, list[vote_queries.GetVoteCountsRow]]:
+    """
+    Atomically apply vote count deltas ({poll_id: {vote_option_id: delta}})
+    to the vote tables of the given polls, using a single round trip to Valkey.
+    Returns the resulting vote counts of every poll, and optionally publishes them.
+
+    The deltas must already be committed to the database: a vote table that has gone
+    missing is recreated from the database instead of having the deltas applied.
+    """
+    poll_ids = list(deltas)
+    all_args = [
+        [
+            poll_id,
+            poll_update_topic(poll_id) if publish else "",
+            *(x for item in deltas[poll_id].items() for x in item),
+        ]
+        for poll_id in poll_ids
+    ]
+
+    async def evalsha_all(indices: list[int]) -> list[object]:
+        pipe = valkey.pipeline(transaction=False)
+        for i in indices:
+            pipe.evalsha(
+                _APPLY_VOTE_DELTAS_SHA, 1, vote_table_key(poll_ids[i]), *all_args[i]
             )
-            return
+        return await pipe.execute(raise_on_error=False)
+
+    results = await evalsha_all(list(range(len(poll_ids))))
+
+    # The script is only loaded into Valkey the first time it is needed
+    missing = [i for i, x in enumerate(results) if isinstance(x, NoScriptError)]
+    if missing:
+        _ = await valkey.script_load(_APPLY_VOTE_DELTAS_LUA)
+        for i, x in zip(missing, await evalsha_all(missing)):
+            results[i] = x
+
+    # Vote tables can get lost, e.g. because Valkey got flushed.
+    # Recreating them from the database already includes the deltas, but only
+    # when read after they were committed, so loads of others aren't waited for
+    lost = [i for i, x in enumerate(results) if x is None]
+    if lost:
+        for i in lost:
+            forget_valkey_vote_table(poll_ids[i])
+            await _rebuild_valkey_vote_table(poll_ids[i], conn, valkey)
+            all_args[i] = all_args[i][:2]
+        for i, x in zip(lost, await evalsha_all(lost)):
+            results[i] = x
+
+    vote_counts: dict[int, list[vote_queries.GetVoteCountsRow]] = {}
+    for poll_id, counts in zip(poll_ids, results):
+        if isinstance(counts, Exception):
+            raise counts
+
+        # Still missing if the poll has no vote options, e.g. if it was deleted
+        counts = counts if isinstance(counts, list) else []
+        vote_counts[poll_id] = [
+            vote_queries.GetVoteCountsRow(vote_option_id=k, vote_count=v)
+            for k, v in zip(counts[::2], counts[1::2])
+        ]
+    return vote_counts
@@ -0,0 +1,30 @@
+-- migrate:up
+ALTER TABLE vote ADD COLUMN poll_id BIGINT;
+
+UPDATE vote v SET poll_id = vo.poll_id
+FROM vote_option vo
+WHERE vo.id = v.vote_option_id;
+
+-- Only keep the latest vote of a user on a poll
+DELETE FROM vote v
+USING vote newer
+WHERE newer.user_id = v.user_id AND newer.poll_id = v.poll_id AND newer.id > v.id;
+
+ALTER TABLE vote ALTER COLUMN poll_id SET NOT NULL;
+
+-- The denormalized poll_id must always match the one of the vote option
+ALTER TABLE vote_option ADD CONSTRAINT vote_option_id_poll_id_key UNIQUE (id, poll_id);
+ALTER TABLE vote DROP CONSTRAINT vote_vote_option_id_fkey;
+ALTER TABLE vote ADD CONSTRAINT vote_vote_option_id_poll_id_fkey
+    FOREIGN KEY (vote_option_id, poll_id) REFERENCES vote_option(id, poll_id);
+
+-- A user can only have one vote per poll
+ALTER TABLE vote ADD CONSTRAINT vote_user_id_poll_id_key UNIQUE (user_id, poll_id);
+
+-- migrate:down
+ALTER TABLE vote DROP CONSTRAINT vote_user_id_poll_id_key;
+ALTER TABLE vote DROP CONSTRAINT vote_vote_option_id_poll_id_fkey;
+ALTER TABLE vote ADD CONSTRAINT vote_vote_option_id_fkey
+    FOREIGN KEY (vote_option_id) REFERENCES vote_option(id);
+ALTER TABLE vote_option DROP CONSTRAINT vote_option_id_poll_id_key;
+ALTER TABLE vote DROP COLUMN poll_id;
@@ -0,0 +1,19 @@
+-- migrate:up
+-- Listing the options of a poll, in presentation order
+CREATE INDEX vote_option_poll_id_idx ON vote_option (poll_id, presentation_order);
+
+-- Counting the votes of an option
+CREATE INDEX vote_vote_option_id_idx ON vote (vote_option_id);
+
+-- Looking up the grants of a user or a poll, e.g. in can_user_do_at.
+-- Only grants that actually refer to a user or poll are indexed
+CREATE INDEX poll_grants_user_id_idx ON poll_grants (user_id, scope)
+    WHERE user_id IS NOT NULL;
+CREATE INDEX poll_grants_poll_id_idx ON poll_grants (poll_id, scope)
+    WHERE poll_id IS NOT NULL;
+
+-- migrate:down
+DROP INDEX IF EXISTS poll_grants_poll_id_idx;
+DROP INDEX IF EXISTS poll_grants_user_id_idx;
+DROP INDEX IF EXISTS vote_vote_option_id_idx;
+DROP INDEX IF EXISTS vote_option_poll_id_idx;
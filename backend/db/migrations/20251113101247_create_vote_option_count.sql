@@ -0,0 +1,16 @@
+-- migrate:up
+-- Vote counts per vote option, kept up to date by the consumer in the same
+-- transaction as the votes, so reading them does not depend on the number of votes
+CREATE TABLE vote_option_count (
+    vote_option_id BIGINT PRIMARY KEY REFERENCES vote_option(id) ON DELETE CASCADE,
+    vote_count BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO vote_option_count (vote_option_id, vote_count)
+SELECT vo.id, count(v.id)
+FROM vote_option vo
+LEFT JOIN vote v ON v.vote_option_id = vo.id
+GROUP BY vo.id;
+
+-- migrate:down
+DROP TABLE IF EXISTS vote_option_count;
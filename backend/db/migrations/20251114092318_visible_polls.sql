@@ -0,0 +1,43 @@
+-- migrate:up
+-- All polls a user can view, as a set instead of a check per poll.
+-- Being a single-statement SQL function, the planner inlines it into the calling query.
+-- Must give the same results as can_user_do_at(p_user_id, poll.id, 'poll:view', p_ts)
+CREATE OR REPLACE FUNCTION visible_polls(
+    p_user_id BIGINT,
+    p_ts TIMESTAMPTZ DEFAULT now()
+)
+RETURNS TABLE (poll_id BIGINT) AS $$
+    SELECT pg.poll_id
+    FROM poll_grants pg
+    JOIN role_permissions rp ON rp.role = pg.role
+    WHERE rp.permission = 'poll:view'
+    AND (p_ts <@ pg.period)
+    AND pg.scope = 'public_poll'
+UNION
+    SELECT pg.poll_id
+    FROM poll_grants pg
+    JOIN role_permissions rp ON rp.role = pg.role
+    WHERE rp.permission = 'poll:view'
+    AND (p_ts <@ pg.period)
+    AND pg.scope = 'user_poll' AND pg.user_id = p_user_id
+UNION
+    -- Global grants, e.g. moderators, give access to every poll
+    SELECT p.id
+    FROM poll p
+    WHERE EXISTS (
+        SELECT 1
+        FROM poll_grants pg
+        JOIN role_permissions rp ON rp.role = pg.role
+        WHERE rp.permission = 'poll:view'
+        AND (p_ts <@ pg.period)
+        AND pg.scope = 'user_global' AND pg.user_id = p_user_id
+    )
+$$ LANGUAGE sql STABLE;
+
+-- Finding all public polls, the other scopes are covered by poll_grants_user_id_idx
+CREATE INDEX poll_grants_public_poll_idx ON poll_grants (poll_id)
+    WHERE scope = 'public_poll';
+
+-- migrate:down
+DROP INDEX IF EXISTS poll_grants_public_poll_idx;
+DROP FUNCTION IF EXISTS visible_polls;
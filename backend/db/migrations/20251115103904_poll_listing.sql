@@ -0,0 +1,11 @@
+-- migrate:up
+-- Poll listings are paginated by (created_at, id), which needs created_at to be set
+UPDATE poll SET created_at = now() WHERE created_at IS NULL;
+ALTER TABLE poll ALTER COLUMN created_at SET NOT NULL;
+
+-- Listing polls newest first, one page at a time
+CREATE INDEX poll_created_at_id_idx ON poll (created_at DESC, id DESC);
+
+-- migrate:down
+DROP INDEX IF EXISTS poll_created_at_id_idx;
+ALTER TABLE poll ALTER COLUMN created_at DROP NOT NULL;
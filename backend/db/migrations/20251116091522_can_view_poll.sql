@@ -0,0 +1,73 @@
+-- migrate:up
+-- Whether a user can view a poll, for checking polls one by one while walking an index,
+-- e.g. poll listings, which can then stop as soon as a page is full.
+-- Being a single-statement SQL function, the planner inlines it into the calling query,
+-- and the check for global grants (e.g. moderators) is only evaluated once per query.
+-- Must give the same results as can_user_do_at(p_user_id, p_poll_id, 'poll:view', p_ts)
+CREATE OR REPLACE FUNCTION can_view_poll(
+    p_user_id BIGINT,
+    p_poll_id BIGINT,
+    p_ts TIMESTAMPTZ DEFAULT now()
+)
+RETURNS BOOLEAN AS $$
+    SELECT EXISTS (
+        SELECT 1
+        FROM poll_grants pg
+        JOIN role_permissions rp ON rp.role = pg.role
+        WHERE rp.permission = 'poll:view'
+        AND (p_ts <@ pg.period)
+        AND pg.poll_id = p_poll_id
+        AND (
+               pg.scope = 'public_poll'
+            OR (pg.scope = 'user_poll' AND pg.user_id = p_user_id)
+        )
+    ) OR EXISTS (
+        SELECT 1
+        FROM poll_grants pg
+        JOIN role_permissions rp ON rp.role = pg.role
+        WHERE rp.permission = 'poll:view'
+        AND (p_ts <@ pg.period)
+        AND pg.scope = 'user_global' AND pg.user_id = p_user_id
+    )
+$$ LANGUAGE sql STABLE;
+
+-- Poll listings no longer build the set of all visible polls
+DROP INDEX IF EXISTS poll_grants_public_poll_idx;
+DROP FUNCTION IF EXISTS visible_polls;
+
+-- migrate:down
+CREATE OR REPLACE FUNCTION visible_polls(
+    p_user_id BIGINT,
+    p_ts TIMESTAMPTZ DEFAULT now()
+)
+RETURNS TABLE (poll_id BIGINT) AS $$
+    SELECT pg.poll_id
+    FROM poll_grants pg
+    JOIN role_permissions rp ON rp.role = pg.role
+    WHERE rp.permission = 'poll:view'
+    AND (p_ts <@ pg.period)
+    AND pg.scope = 'public_poll'
+UNION
+    SELECT pg.poll_id
+    FROM poll_grants pg
+    JOIN role_permissions rp ON rp.role = pg.role
+    WHERE rp.permission = 'poll:view'
+    AND (p_ts <@ pg.period)
+    AND pg.scope = 'user_poll' AND pg.user_id = p_user_id
+UNION
+    SELECT p.id
+    FROM poll p
+    WHERE EXISTS (
+        SELECT 1
+        FROM poll_grants pg
+        JOIN role_permissions rp ON rp.role = pg.role
+        WHERE rp.permission = 'poll:view'
+        AND (p_ts <@ pg.period)
+        AND pg.scope = 'user_global' AND pg.user_id = p_user_id
+    )
+$$ LANGUAGE sql STABLE;
+
+CREATE INDEX poll_grants_public_poll_idx ON poll_grants (poll_id)
+    WHERE scope = 'public_poll';
+
+DROP FUNCTION IF EXISTS can_view_poll;
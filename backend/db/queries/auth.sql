@@ -3,6 +3,25 @@ SELECT can_user_do_at(
     sqlc.narg(user_id), sqlc.narg(poll_id),
     sqlc.arg(permission), COALESCE(sqlc.narg(timestamp), now()));
 
+-- name: CanUserDoUntil :one
+-- Also returns until when the decision is known to hold:
+-- the first start or end of a relevant grant period after now, if any
+SELECT can_user_do_at(
+    sqlc.narg(user_id), sqlc.narg(poll_id), sqlc.arg(permission), now()) AS allowed,
+    (
+        SELECT min(b.boundary)
+        FROM poll_grants pg
+        JOIN role_permissions rp ON rp.role = pg.role
+        CROSS JOIN LATERAL (VALUES (lower(pg.period)), (upper(pg.period))) AS b(boundary)
+        WHERE rp.permission = sqlc.arg(permission)
+        AND b.boundary > now() AND isfinite(b.boundary)
+        AND (
+               (pg.scope = 'user_poll'   AND pg.user_id = sqlc.narg(user_id) AND pg.poll_id = sqlc.narg(poll_id))
+            OR (pg.scope = 'user_global' AND pg.user_id = sqlc.narg(user_id))
+            OR (pg.scope = 'public_poll' AND pg.poll_id = sqlc.narg(poll_id))
+        )
+    )::timestamptz AS valid_until;
+
 -- name: MakeModerator :exec
 INSERT INTO poll_grants (role, scope, user_id, expires_at)
 VALUES ('moderator', 'user_global', $1, $2);
@@ -1,50 +1,99 @@
 -- name: CreatePoll :one
-INSERT INTO poll (question, created_by, expires_at)
-VALUES ($1, $2, $3)
-RETURNING id;
-
--- name: AssignRole :exec
-INSERT INTO poll_grants (role, scope, user_id, poll_id)
-VALUES ($1, 'user_poll', $2, $3);
+-- Creates a poll with its vote options, the grant of its creator and an optional public grant.
+-- Returns the poll as shown to its creator
+WITH new_poll AS (
+    INSERT INTO poll (question, created_by, expires_at)
+    VALUES (sqlc.arg(question), sqlc.arg(created_by), sqlc.narg(expires_at))
+    RETURNING id, question, expires_at, created_by
+), creator_grant AS (
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT 'creator', 'user_poll', created_by, id FROM new_poll
+), public_grant AS (
+    INSERT INTO poll_grants (role, scope, poll_id)
+    SELECT sqlc.narg(public_role)::role, 'public_poll', id FROM new_poll
+    WHERE sqlc.narg(public_role)::role IS NOT NULL
+), new_vote_option AS (
+    INSERT INTO vote_option (caption, poll_id, presentation_order)
+    SELECT o.caption, p.id, o.ordinality - 1
+    FROM new_poll p
+    CROSS JOIN unnest(sqlc.arg(options)::text[]) WITH ORDINALITY AS o(caption, ordinality)
+    RETURNING id, caption, presentation_order
+)
+SELECT p.id, p.question, p.expires_at, u.username as creator_name,
+    array_agg(vo.caption ORDER BY vo.presentation_order)::text[] AS options,
+    array_agg(vo.id ORDER BY vo.presentation_order)::bigint[] AS option_ids,
+    NULL::bigint AS user_vote
+FROM new_poll p
+INNER JOIN "user" u ON p.created_by = u.id
+CROSS JOIN new_vote_option vo
+GROUP BY p.id, p.question, p.expires_at, u.id;
 
--- name: AssignPublicPerms :exec
-INSERT INTO poll_grants (role, scope, poll_id)
-VALUES ($1, 'public_poll', $2);
+-- name: AssignRoles :many
+-- Grants roles on a poll to many users at once.
+-- Returns the users that did not get their role, as they do not exist or already have it
+WITH requested AS (
+    SELECT * FROM unnest(
+        sqlc.arg(user_ids)::bigint[],
+        sqlc.arg(roles)::role[]
+    ) AS x(user_id, role)
+), granted AS (
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT r.role, 'user_poll', r.user_id, sqlc.arg(poll_id)
+    FROM requested r
+    WHERE EXISTS (SELECT 1 FROM "user" u WHERE u.id = r.user_id)
+    ON CONFLICT DO NOTHING  -- Also skips grants violating the exclusion constraint
+    RETURNING user_id, role
+)
+SELECT r.user_id FROM requested r
+WHERE NOT EXISTS (
+    SELECT 1 FROM granted g WHERE g.user_id = r.user_id AND g.role = r.role
+);
 
 -- name: GetActivePollRoles :many
 SELECT pg.role, u.username FROM poll_grants pg
 INNER JOIN "user" u ON u.id = pg.user_id
 WHERE poll_id = $1 AND scope = 'user_poll' AND now() <@ period;
 
--- name: CreateVoteOption :exec
-INSERT INTO vote_option (caption, poll_id, presentation_order)
-VALUES ($1, $2, $3);
-
--- name: PollOptionBelongsToPoll :one
-SELECT true FROM vote_option
-WHERE poll_id = sqlc.arg(poll_id) AND id = sqlc.arg(poll_option_id);
-
--- name: GetPoll :one
+-- name: GetPollDocument :one
+-- Everything about a poll that is the same for every user, without their vote
 SELECT p.id, p.question, p.expires_at, u.username as creator_name,
     array_agg(vo.caption ORDER BY vo.presentation_order)::text[] AS options,
-    array_agg(vo.id ORDER BY vo.presentation_order)::bigint[] AS option_ids,
-    max(v.vote_option_id) as user_vote
+    array_agg(vo.id ORDER BY vo.presentation_order)::bigint[] AS option_ids
 FROM poll p
 INNER JOIN vote_option vo ON p.id = vo.poll_id
 INNER JOIN "user" u ON p.created_by = u.id
-LEFT JOIN vote v ON v.vote_option_id = vo.id AND v.user_id = sqlc.narg(user_id)
-WHERE p.id = sqlc.arg(poll_id) AND can_user_do_at(sqlc.narg(user_id), sqlc.arg(poll_id), 'poll:view')
+WHERE p.id = $1
 GROUP BY p.id, u.id;
 
+-- name: GetPollMetadata :one
+SELECT p.id, p.expires_at, p.created_by,
+    array_agg(vo.id ORDER BY vo.presentation_order)::bigint[] AS option_ids
+FROM poll p
+INNER JOIN vote_option vo ON p.id = vo.poll_id
+WHERE p.id = $1
+GROUP BY p.id;
+
 -- name: GetPolls :many
-SELECT p.id, p.question, p.expires_at, u.username as creator_name,
+-- Newest first, continuing after the (created_at, id) of the last poll of the previous page.
+-- Lists every remaining poll if no page size is given
+SELECT p.id, p.question, p.expires_at, p.created_at, u.username as creator_name,
     array_agg(vo.caption ORDER BY vo.presentation_order)::text[] AS options,
     array_agg(vo.id ORDER BY vo.presentation_order)::bigint[] AS option_ids
-FROM poll p
+FROM (
+    -- Walks poll_created_at_id_idx, checking every poll until the page is full
+    SELECT * FROM poll
+    WHERE can_view_poll(sqlc.narg(user_id), id)
+    AND (created_at, id) < (
+        coalesce(sqlc.narg(after_created_at)::timestamptz, 'infinity'),
+        coalesce(sqlc.narg(after_id)::bigint, 0)
+    )
+    ORDER BY created_at DESC, id DESC
+    LIMIT sqlc.narg(page_size)
+) p
 INNER JOIN vote_option vo ON p.id = vo.poll_id
 INNER JOIN "user" u ON p.created_by = u.id
-WHERE can_user_do_at(sqlc.narg(user_id), p.id, 'poll:view')
-GROUP BY p.id, u.id;
+GROUP BY p.id, p.question, p.expires_at, p.created_at, u.id
+ORDER BY p.created_at DESC, p.id DESC;
 
 -- name: DeleteGrantsForPoll :exec
 DELETE FROM poll_grants WHERE poll_id = $1;
@@ -1,19 +1,62 @@
--- name: DeleteUserVoteOnPoll :one
-DELETE FROM vote
-WHERE vote_option_id IN (
-    SELECT id FROM vote_option WHERE poll_id = $1
-) AND user_id = $2
-RETURNING vote_option_id;
+-- name: UpsertVotes :many
+WITH new_vote AS (
+    SELECT * FROM unnest(
+        sqlc.arg(user_ids)::bigint[],
+        sqlc.arg(poll_ids)::bigint[],
+        sqlc.arg(vote_option_ids)::bigint[]
+    ) AS x(user_id, poll_id, vote_option_id)
+), old_vote AS (
+    -- Sees the votes as they were before the upsert, as all CTEs share a snapshot.
+    -- Not locked: rows the upsert modifies would be skipped by FOR UPDATE,
+    -- and the consumer lanes already serialize writers of a poll
+    SELECT v.user_id, v.poll_id, v.vote_option_id FROM vote v
+    INNER JOIN new_vote n ON n.user_id = v.user_id AND n.poll_id = v.poll_id
+), upserted AS (
+    INSERT INTO vote (user_id, poll_id, vote_option_id)
+    SELECT user_id, poll_id, vote_option_id FROM new_vote
+    ON CONFLICT (user_id, poll_id) DO UPDATE
+    SET vote_option_id = EXCLUDED.vote_option_id, created_at = now()
+    RETURNING user_id, poll_id, vote_option_id
+)
+SELECT u.poll_id, o.vote_option_id AS old_vote_option_id, u.vote_option_id
+FROM upserted u
+LEFT JOIN old_vote o ON o.user_id = u.user_id AND o.poll_id = u.poll_id;
 
--- name: SubmitVote :exec
-INSERT INTO vote (user_id, vote_option_id)
-VALUES ($1, $2);
+-- name: ApplyVoteCountDeltas :exec
+-- Rows are locked in a fixed order, so concurrent transactions cannot deadlock
+INSERT INTO vote_option_count (vote_option_id, vote_count)
+SELECT vote_option_id, delta FROM unnest(
+    sqlc.arg(vote_option_ids)::bigint[],
+    sqlc.arg(deltas)::bigint[]
+) AS x(vote_option_id, delta)
+ORDER BY vote_option_id
+ON CONFLICT (vote_option_id) DO UPDATE
+SET vote_count = vote_option_count.vote_count + EXCLUDED.vote_count;
+
+-- name: AuthorizeVote :one
+-- Checks everything needed to accept a vote, in order of precedence.
+-- Returns 'ok', or the reason the vote is rejected
+SELECT (CASE
+    WHEN NOT can_user_do_at(sqlc.arg(user_id), sqlc.arg(poll_id), 'poll:vote', sqlc.arg(timestamp))
+        THEN 'forbidden'
+    WHEN p.expires_at <= sqlc.arg(timestamp) THEN 'expired'
+    WHEN NOT EXISTS (
+        SELECT 1 FROM vote_option vo
+        WHERE vo.poll_id = sqlc.arg(poll_id) AND vo.id = sqlc.arg(vote_option_id)
+    ) THEN 'invalid_option'
+    ELSE 'ok'
+END)::text AS result
+FROM (SELECT 1) AS always_one_row
+LEFT JOIN poll p ON p.id = sqlc.arg(poll_id);
 
 -- name: GetVoteCounts :many
-SELECT vo.id as vote_option_id, count(v.id) AS vote_count
-FROM poll p
-INNER JOIN vote_option vo ON p.id = vo.poll_id
-LEFT JOIN vote v ON v.vote_option_id = vo.id  -- Keep options with 0 votes
-WHERE p.id = $1
-GROUP BY vo.id
+SELECT vo.id as vote_option_id, coalesce(c.vote_count, 0)::bigint AS vote_count
+FROM vote_option vo
+LEFT JOIN vote_option_count c ON c.vote_option_id = vo.id  -- Keep options with 0 votes
+WHERE vo.poll_id = $1
 ORDER BY vo.presentation_order;
+
+-- name: GetUserVote :one
+-- The option a user voted for on a poll, using the (user_id, poll_id) unique index
+SELECT vote_option_id FROM vote
+WHERE user_id = $1 AND poll_id = $2;
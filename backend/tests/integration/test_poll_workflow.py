@@ -1,5 +1,6 @@
 import base64
 import datetime
+import json
 import random
 
 from fastapi import status
@@ -68,22 +69,59 @@ def test_full_poll_workflow(client: TestClient):
 
     # 4. Any user can get all polls
     get_polls_response = client.get("api/poll/all")
+    assert get_polls_response.status_code == status.HTTP_200_OK
     assert len(get_polls_response.json()) == 2, "Failed to get all polls"
+    assert "X-Next-Cursor" not in get_polls_response.headers, "Unexpected next page"
 
-    # 5. User can delete their own poll
+    # Polls can be listed one page at a time, newest first
+    first_page = client.get("api/poll/all", params={"limit": 1})
+    assert first_page.json() == get_polls_response.json()[:1]
+    second_page = client.get(
+        "api/poll/all",
+        params={"limit": 1, "cursor": first_page.headers["X-Next-Cursor"]},
+    )
+    assert second_page.json() == get_polls_response.json()[1:]
+    assert "X-Next-Cursor" not in second_page.headers, "Unexpected next page"
+
+    # Or streamed as newline delimited JSON
+    stream_response = client.get("api/poll/all/stream")
+    assert [
+        json.loads(line) for line in stream_response.text.splitlines()
+    ] == get_polls_response.json(), "Failed to stream all polls"
+
+    # 5. User can give roles on their poll to other users, in bulk
+    user_2 = client.post("/api/user/register", json=user_data_2).json()
+    _ = client.post("api/user/login", json=login_payload_1)
+    assign_payload = [
+        {"role": "voter", "user_id": user_2["id"]},
+        {"role": "voter", "user_id": -1},
+    ]
+    poll_id = get_polls_response.json()[0]["id"]
+    assign_response = client.post(
+        "api/poll/assign/", params={"poll_id": poll_id}, json=assign_payload
+    )
+    assert assign_response.json() == [-1], "Failed to reject an unknown user"
+
+    # The user already has the role now
+    assign_response = client.post(
+        "api/poll/assign/", params={"poll_id": poll_id}, json=assign_payload
+    )
+    assert sorted(assign_response.json()) == [-1, user_2["id"]]
+
+    # 6. User can delete their own poll
     user_owned_poll = get_polls_response.json()[0]["id"]
     deleted_response = client.delete(f"api/poll/{user_owned_poll}")
     assert (
         deleted_response.status_code == status.HTTP_204_NO_CONTENT
     ), f"Failed to delete poll with id {user_owned_poll}"
 
-    # 6. User cannot delete an already deleted poll
+    # 7. User cannot delete an already deleted poll
     deleted_response = client.delete(f"api/poll/{user_owned_poll}")
     assert (
         deleted_response.status_code == status.HTTP_401_UNAUTHORIZED
     ), "Unexpectedly deleted poll"
 
-    # 7. User cannot delete another users poll
+    # 8. User cannot delete another users poll
     _ = client.post("api/user/logout")
     _ = client.post("api/user/create", json=user_data_2)
     _ = client.post("api/user/login", json=login_payload_2)
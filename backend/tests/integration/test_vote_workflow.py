@@ -1,9 +1,19 @@
+import asyncio
 import base64
 import datetime
 import random
 
 from fastapi import status
 from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
+from valkey.asyncio import ConnectionPool, Valkey
+
+from app.config import Settings
+from app.consume import process_votes
+from app.db.kafka import VoteEvent
+from app.db.sqlc import vote as vote_queries
+from app.utils.poll_metadata import TieredPollMetadataCache
+from app.utils.vote_counter import get_valkey_vote_counts
 
 
 def test_full_poll_workflow(client: TestClient):
@@ -71,3 +81,81 @@ def test_full_poll_workflow(client: TestClient):
     assert (
         register_vote.status_code == status.HTTP_404_NOT_FOUND
     ), "Unexpected vote on non-existing vote-option"
+
+    # 5. Trying to vote on an expired poll.
+    poll_data_expired = {
+        **poll_data_expiry,
+        "expires_at": (
+            datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)
+        ).isoformat(),
+    }
+    expired_poll = client.post("/api/poll/create", json=poll_data_expired).json()
+    vote_data_expired_poll = {
+        "vote_option_id": expired_poll["option_ids"][0],
+        "poll_id": expired_poll["id"],
+    }
+    register_vote = client.post("/api/vote/submit", json=vote_data_expired_poll)
+    assert (
+        register_vote.status_code == status.HTTP_403_FORBIDDEN
+    ), "Unexpectedly voted on expired poll."
+
+
+def test_changed_vote_moves_the_count(client: TestClient, test_settings: Settings):
+    random_suffix = random.randint(1000, 9999)
+    password = str(base64.encodebytes(random.randbytes(100)))
+    user_data = {
+        "username": f"testuser_{random_suffix}",
+        "email": f"testuser_{random_suffix}@example.com",
+        "password": password,
+    }
+    _ = client.post("/api/user/register", json=user_data)
+    _ = client.post(
+        "/api/user/login",
+        json={"username": user_data["username"], "password": password},
+    )
+    user_id = client.get("/api/user/me").json()["id"]
+    poll = client.post(
+        "/api/poll/create",
+        json={
+            "question": f"testquestion_{random_suffix}",
+            "options": ["first", "second"],
+            "poll_perms": "public_vote",
+            "expires_at": None,
+        },
+    ).json()
+    first, second = poll["option_ids"]
+
+    # Votes are processed by the consumer, so it's called directly
+    async def vote_and_count(vote_option_id: int):
+        engine = create_async_engine(test_settings.test_database_url)
+        pool = ConnectionPool.from_url(test_settings.VALKEY_CONN_STR)
+        poll_metadata = TieredPollMetadataCache(pool, max_size=10, ttl=60)
+        try:
+            async with engine.connect() as conn, Valkey(connection_pool=pool) as valkey:
+                vote = VoteEvent(user_id=user_id, poll_option_id=vote_option_id)
+                await process_votes(
+                    [(poll["id"], vote)], conn, valkey, poll_metadata, None
+                )
+
+                q = vote_queries.AsyncQuerier(conn)
+                db_counts = {
+                    x.vote_option_id: x.vote_count
+                    async for x in q.get_vote_counts(id=poll["id"])
+                }
+                valkey_counts = {
+                    x.vote_option_id: x.vote_count
+                    for x in await get_valkey_vote_counts(poll["id"], conn, valkey)
+                }
+                await conn.commit()
+                return db_counts, valkey_counts
+        finally:
+            await engine.dispose()
+            await pool.aclose()
+
+    # 1. The first vote counts for its option
+    db_counts, valkey_counts = asyncio.run(vote_and_count(first))
+    assert db_counts == valkey_counts == {first: 1, second: 0}
+
+    # 2. Changing the vote takes the count away from the old option
+    db_counts, valkey_counts = asyncio.run(vote_and_count(second))
+    assert db_counts == valkey_counts == {first: 0, second: 1}
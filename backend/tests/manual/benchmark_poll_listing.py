@@ -0,0 +1,125 @@
+import asyncio
+import os
+import statistics
+import subprocess
+import time
+
+import sqlalchemy
+import uvloop
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from app.config import Settings
+from app.db.sqlc import poll as poll_queries
+
+POLLS = int(os.environ.get("BENCHMARK_POLLS", 100_000))
+USERS = int(os.environ.get("BENCHMARK_USERS", 10_000))
+RUNS = 5
+
+# GetPolls as it was, checking can_user_do_at() for every poll
+LEGACY_GET_POLLS = """
+SELECT p.id, p.question, p.expires_at, u.username as creator_name,
+    array_agg(vo.caption ORDER BY vo.presentation_order)::text[] AS options,
+    array_agg(vo.id ORDER BY vo.presentation_order)::bigint[] AS option_ids
+FROM poll p
+INNER JOIN vote_option vo ON p.id = vo.poll_id
+INNER JOIN "user" u ON p.created_by = u.id
+WHERE can_user_do_at(:p1, p.id, 'poll:view')
+GROUP BY p.id, u.id
+"""
+
+# A third of the polls is publicly viewable, a third publicly votable,
+# and a third is private with a few invited voters
+SEED_STATEMENTS = [
+    """
+    INSERT INTO "user" (username, email, password_hash)
+    SELECT 'user-' || i, 'user-' || i || '@example.com', 'not-a-hash'
+    FROM generate_series(1, :users) i
+    """,
+    """
+    INSERT INTO poll (question, created_by)
+    SELECT 'Question ' || i, 1 + i % :users FROM generate_series(1, :polls) i
+    """,
+    """
+    INSERT INTO vote_option (poll_id, caption, presentation_order)
+    SELECT p, 'Option ' || o, o
+    FROM generate_series(1, :polls) p, generate_series(0, 3) o
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT 'creator', 'user_poll', created_by, id FROM poll
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, poll_id)
+    SELECT CASE WHEN id % 3 = 0 THEN 'viewer' ELSE 'voter' END::role,
+        'public_poll', id
+    FROM poll WHERE id % 3 <> 2
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT 'voter', 'user_poll', 1 + (p * 7 + i) % :users, p
+    FROM generate_series(2, :polls, 3) p, generate_series(1, 5) i
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, user_id)
+    VALUES ('moderator', 'user_global', 1)
+    """,
+    "ANALYZE",
+]
+
+
+async def seed(engine: AsyncEngine):
+    params = {"users": USERS, "polls": POLLS}
+    async with engine.begin() as conn:
+        for statement in SEED_STATEMENTS:
+            _ = await conn.execute(sqlalchemy.text(statement), params)
+
+
+async def time_query(
+    engine: AsyncEngine, query: str, user_id: int | None, page_size: int | None
+):
+    durations: list[float] = []
+    rows = 0
+    async with engine.connect() as conn:
+        for _ in range(RUNS):
+            start = time.perf_counter()
+            result = await conn.execute(
+                sqlalchemy.text(query),
+                {"p1": user_id, "p2": None, "p3": None, "p4": page_size},
+            )
+            rows = len(result.all())
+            durations.append(time.perf_counter() - start)
+    return statistics.median(durations), rows
+
+
+async def benchmark_poll_listing():
+    settings = Settings()  # pyright: ignore[reportCallIssue]
+    database_url = settings.test_database_url + "_listing"
+
+    env = os.environ.copy()
+    env["DATABASE_URL"] = database_url.replace("+asyncpg", "") + "?sslmode=disable"
+    subprocess.run(["dbmate", "drop"], env=env, check=True, capture_output=True)
+    subprocess.run(["dbmate", "up"], env=env, check=True, capture_output=True)
+
+    engine = create_async_engine(database_url)
+    print(f"Seeding {POLLS} polls and {USERS} users...")
+    await seed(engine)
+
+    users = {"anonymous": None, "moderator": 1, "regular user": 2}
+    queries = {
+        "can_user_do_at": (LEGACY_GET_POLLS, None),
+        "can_view_poll": (poll_queries.GET_POLLS, None),
+        "first page": (poll_queries.GET_POLLS, 101),
+    }
+    for user_name, user_id in users.items():
+        for query_name, (query, page_size) in queries.items():
+            duration, rows = await time_query(engine, query, user_id, page_size)
+            print(
+                f"{user_name:>12}, {query_name:>14}: "
+                f"{duration * 1000:8.1f} ms (median of {RUNS}), {rows} polls"
+            )
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    uvloop.run(benchmark_poll_listing())
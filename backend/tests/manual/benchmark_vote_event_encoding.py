@@ -0,0 +1,65 @@
+import timeit
+
+from app.db.kafka import (
+    VoteEvent,
+    _deserialize_key,
+    _deserialize_value,
+    _serialize_key,
+    _serialize_value,
+)
+
+
+def _serialize_key_json(k: int) -> bytes:
+    return str(k).encode()
+
+
+def _deserialize_key_json(k: bytes) -> int:
+    return int(k.decode())
+
+
+def _serialize_value_json(x: VoteEvent) -> bytes:
+    return x.model_dump_json().encode()
+
+
+def _deserialize_value_json(x: bytes) -> VoteEvent:
+    return VoteEvent.model_validate_json(x.decode())
+
+
+def benchmark_vote_event_encoding():
+    number = 200_000
+    poll_id = 123_456
+    vote = VoteEvent(user_id=9_876_543, poll_option_id=1_234_567)
+
+    formats = {
+        "json (legacy)": (
+            _serialize_key_json,
+            _deserialize_key_json,
+            _serialize_value_json,
+            _deserialize_value_json,
+        ),
+        "binary v1": (
+            _serialize_key,
+            _deserialize_key,
+            _serialize_value,
+            _deserialize_value,
+        ),
+    }
+
+    for name, (ser_key, de_key, ser_value, de_value) in formats.items():
+        key, value = ser_key(poll_id), ser_value(vote)
+        assert de_key(key) == poll_id and de_value(value) == vote
+
+        encode = timeit.timeit(
+            lambda: (ser_key(poll_id), ser_value(vote)), number=number
+        )
+        decode = timeit.timeit(lambda: (de_key(key), de_value(value)), number=number)
+        print(
+            f"{name:>14}: "
+            f"encode {encode / number * 1e9:6.0f} ns/msg, "
+            f"decode {decode / number * 1e9:6.0f} ns/msg, "
+            f"{len(key) + len(value)} bytes/msg (key {len(key)}, value {len(value)})"
+        )
+
+
+if __name__ == "__main__":
+    benchmark_vote_event_encoding()
@@ -0,0 +1,110 @@
+import asyncio
+import os
+import subprocess
+from collections.abc import Callable, Generator
+from typing import Any
+
+import pytest
+import sqlalchemy
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+
+from app.config import Settings
+
+# Scale of the seeded database, votes are spread over a few very popular polls
+SEED_USERS = int(os.environ.get("QUERY_PLAN_SEED_USERS", 100_000))
+SEED_POLLS = int(os.environ.get("QUERY_PLAN_SEED_POLLS", 50_000))
+SEED_VOTES = int(os.environ.get("QUERY_PLAN_SEED_VOTES", 2_000_000))
+
+SEED_STATEMENTS = [
+    """
+    INSERT INTO "user" (username, email, password_hash)
+    SELECT 'user-' || i, 'user-' || i || '@example.com', 'not-a-hash'
+    FROM generate_series(1, :users) i
+    """,
+    """
+    INSERT INTO poll (question, created_by, expires_at)
+    SELECT 'Question ' || i, 1 + i % :users,
+        CASE WHEN i % 3 = 0 THEN now() + interval '1 day' END
+    FROM generate_series(1, :polls) i
+    """,
+    """
+    INSERT INTO vote_option (poll_id, caption, presentation_order)
+    SELECT p, 'Option ' || o, o
+    FROM generate_series(1, :polls) p, generate_series(0, 3) o
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT 'creator', 'user_poll', created_by, id FROM poll
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, poll_id)
+    SELECT 'voter', 'public_poll', id FROM poll WHERE id % 2 = 0
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, user_id, poll_id)
+    SELECT 'voter', 'user_poll', 1 + (i * 7) % :users, i FROM generate_series(1, :polls) i
+    WHERE i % 2 = 1
+    """,
+    """
+    INSERT INTO poll_grants (role, scope, user_id)
+    SELECT 'moderator', 'user_global', i FROM generate_series(1, :users, 1000) i
+    """,
+    """
+    INSERT INTO vote (user_id, poll_id, vote_option_id)
+    SELECT 1 + i % :users, vo.poll_id, vo.id
+    FROM generate_series(0, :votes - 1) i
+    INNER JOIN vote_option vo
+        ON vo.poll_id = 1 + i / :users AND vo.presentation_order = i % 4
+    """,
+    """
+    INSERT INTO vote_option_count (vote_option_id, vote_count)
+    SELECT vote_option_id, count(*) FROM vote GROUP BY vote_option_id
+    """,
+]
+
+
+async def _seed(engine: AsyncEngine):
+    params = {"users": SEED_USERS, "polls": SEED_POLLS, "votes": SEED_VOTES}
+    async with engine.begin() as conn:
+        for statement in SEED_STATEMENTS:
+            _ = await conn.execute(sqlalchemy.text(statement), params)
+
+        # Make sure the planner knows how large the tables are
+        _ = await conn.execute(sqlalchemy.text("ANALYZE"))
+
+
+async def _explain(engine: AsyncEngine, query: str, params: dict[str, Any]) -> Any:
+    async with engine.connect() as conn:
+        result = await conn.execute(
+            sqlalchemy.text(f"EXPLAIN (FORMAT JSON) {query}"), params
+        )
+        return result.scalar_one()[0]["Plan"]
+
+
+@pytest.fixture(scope="session")
+def explain(
+    test_settings: Settings,
+) -> Generator[Callable[[str, dict[str, Any]], Any], None, None]:
+    """
+    Creates a separate, seeded database for inspecting query plans.
+    Returns a function that gets the plan of a query (without running it).
+    """
+    database_url = test_settings.test_database_url + "_plans"
+
+    env = os.environ.copy()
+    env["DATABASE_URL"] = database_url.replace("+asyncpg", "") + "?sslmode=disable"
+
+    print("Creating and migrating query plan database...")
+    subprocess.run(["dbmate", "drop"], env=env, check=True, capture_output=True)
+    subprocess.run(["dbmate", "up"], env=env, check=True, capture_output=True)
+
+    loop = asyncio.new_event_loop()
+    engine = create_async_engine(database_url)
+
+    print("Seeding query plan database...")
+    loop.run_until_complete(_seed(engine))
+
+    yield lambda query, params: loop.run_until_complete(_explain(engine, query, params))
+
+    loop.run_until_complete(engine.dispose())
+    loop.close()
@@ -0,0 +1,135 @@
+import json
+import os
+from collections.abc import Callable, Iterator
+from datetime import datetime, timezone
+from types import ModuleType
+from typing import Any
+
+import pytest
+
+from app.db.sqlc import auth, poll, user, vote
+
+# Seeding the database takes minutes, so these only run when asked for
+pytestmark = pytest.mark.skipif(
+    not os.environ.get("QUERY_PLAN_TESTS"), reason="Set QUERY_PLAN_TESTS=1 to run"
+)
+
+# Tables that are expected to grow large in production
+LARGE_TABLES = {"user", "poll", "vote_option", "vote", "poll_grants"}
+
+# Parameters to plan every query with, referring to rows of the seeded database
+SAMPLE_PARAMS: dict[str, dict[str, Any]] = {
+    # auth.sql
+    "can_user_do_at": {"p1": 1, "p2": 1, "p3": "poll:vote", "p4": None},
+    "can_user_do_until": {"p1": 1, "p2": 1, "p3": "poll:view"},
+    "make_moderator": {"p1": 1, "p2": None},
+    "remove_moderator": {"p1": 1},
+    # poll.sql
+    "assign_roles": {"p1": [1, 2], "p2": ["voter", "viewer"], "p3": 1},
+    "create_poll": {
+        "p1": "Question?",
+        "p2": 1,
+        "p3": None,
+        "p4": "voter",
+        "p5": ["Yes", "No"],
+    },
+    "delete_grants_for_poll": {"p1": 1},
+    "delete_poll": {"p1": 1},
+    "delete_vote_options_for_poll": {"p1": 1},
+    "get_active_poll_roles": {"p1": 1},
+    "get_poll_document": {"p1": 1},
+    "get_poll_metadata": {"p1": 1},
+    "get_polls": {"p1": 1, "p2": None, "p3": None, "p4": 101},
+    # user.sql
+    "create_user": {"p1": "username", "p2": "user@example.com", "p3": "hash"},
+    "get_user": {"p1": 1},
+    "get_user_by_username_or_email": {"p1": "user-1"},
+    # vote.sql
+    "apply_vote_count_deltas": {"p1": [1, 2], "p2": [-1, 1]},
+    "authorize_vote": {"p1": 1, "p2": 1, "p3": datetime.now(timezone.utc), "p4": 1},
+    "get_user_vote": {"p1": 1, "p2": 1},
+    "get_vote_counts": {"p1": 1},
+    "upsert_votes": {"p1": [1, 2], "p2": [1, 1], "p3": [1, 2]},
+}
+
+# Queries that inherently read (almost) all rows of a large table
+ALLOWED_SEQ_SCANS: dict[str, set[str]] = {}
+
+# can_user_do_at() is a plpgsql function, which is opaque to EXPLAIN.
+# Its body is planned separately, to make sure it is covered too
+CAN_USER_DO_AT_BODY = """
+SELECT EXISTS (
+    SELECT 1
+    FROM poll_grants pg
+    JOIN role_permissions rp ON rp.role = pg.role
+    WHERE rp.permission = CAST(:permission AS permission)
+    AND (now() <@ pg.period)
+    AND (
+           (pg.scope = 'user_poll'   AND pg.user_id = :user_id AND pg.poll_id = :poll_id)
+        OR (pg.scope = 'user_global' AND pg.user_id = :user_id)
+        OR (pg.scope = 'public_poll' AND pg.poll_id = :poll_id)
+    )
+)
+"""
+
+
+def _sqlc_queries() -> dict[str, str]:
+    """Find every query generated by sqlc"""
+    modules: list[ModuleType] = [auth, poll, user, vote]
+    queries: dict[str, str] = {}
+    for module in modules:
+        for value in vars(module).values():
+            if isinstance(value, str) and value.startswith("-- name: "):
+                name = value.removeprefix("-- name: ").split()[0]
+                queries[name] = value
+    return queries
+
+
+def _nodes(plan: dict[str, Any]) -> Iterator[dict[str, Any]]:
+    yield plan
+    for subplan in plan.get("Plans", []):
+        yield from _nodes(subplan)
+
+
+def _seq_scanned_tables(plan: dict[str, Any]) -> Iterator[str]:
+    for node in _nodes(plan):
+        if node["Node Type"] == "Seq Scan":
+            yield node["Relation Name"]
+
+
+@pytest.mark.parametrize("name,query", sorted(_sqlc_queries().items()))
+def test_no_seq_scan_on_large_tables(
+    name: str, query: str, explain: Callable[[str, dict[str, Any]], Any]
+):
+    assert name in SAMPLE_PARAMS, f"Add sample parameters for query {name}"
+
+    plan = explain(query, SAMPLE_PARAMS[name])
+    seq_scanned = set(_seq_scanned_tables(plan)) & LARGE_TABLES
+    seq_scanned -= ALLOWED_SEQ_SCANS.get(name, set())
+
+    assert not seq_scanned, f"Query {name} sequentially scans {seq_scanned}: {plan}"
+
+
+def test_can_user_do_at_uses_indexes(explain: Callable[[str, dict[str, Any]], Any]):
+    params = {"user_id": 1, "poll_id": 1, "permission": "poll:vote"}
+    plan = explain(CAN_USER_DO_AT_BODY, params)
+    seq_scanned = set(_seq_scanned_tables(plan)) & LARGE_TABLES
+
+    assert not seq_scanned, f"can_user_do_at sequentially scans {seq_scanned}: {plan}"
+
+
+@pytest.mark.parametrize("user_id", [None, 1, 2])
+def test_poll_listing_stops_after_a_page(
+    user_id: int | None, explain: Callable[[str, dict[str, Any]], Any]
+):
+    # Anonymous, a moderator, and a regular user
+    plan = explain(poll.GET_POLLS, {**SAMPLE_PARAMS["get_polls"], "p1": user_id})
+    limited_index_scans = [
+        node["Plans"][0].get("Index Name")
+        for node in _nodes(plan)
+        if node["Node Type"] == "Limit"
+        and node["Plans"][0]["Node Type"] == "Index Scan"
+    ]
+
+    assert "poll_created_at_id_idx" in limited_index_scans, f"Not paged: {plan}"
+    assert "can_view_poll" not in json.dumps(plan), f"Not inlined: {plan}"
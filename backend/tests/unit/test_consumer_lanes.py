@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+from aiokafka import ConsumerRecord
+
+from app.db.kafka import VoteEvent
+from app.utils.consumer_lanes import ConsumerLanes
+
+
+class UnreachableEngine:
+    def connect(self):
+        raise ConnectionRefusedError("database is restarting")
+
+
+async def never_called(*_):
+    raise AssertionError("Votes must not be processed")
+
+
+def vote_record(offset: int) -> ConsumerRecord[int, VoteEvent]:
+    return ConsumerRecord(
+        topic="vote-event",
+        partition=0,
+        offset=offset,
+        timestamp=0,
+        timestamp_type=0,
+        key=1,
+        value=VoteEvent(user_id=1, poll_option_id=1),
+        checksum=None,
+        serialized_key_size=9,
+        serialized_value_size=17,
+        headers=(),
+    )
+
+
+def test_lane_that_cannot_connect_fails_without_blocking():
+    async def main():
+        lanes = ConsumerLanes(
+            1, 2, UnreachableEngine(), None, never_called  # pyright: ignore
+        )
+        lanes.start()
+        # More messages than fit in the lane's queue
+        async with asyncio.timeout(1):
+            for offset in range(5):
+                await lanes.submit(vote_record(offset))
+            await lanes.drain()
+        await lanes.stop()
+        return lanes
+
+    lanes = asyncio.run(main())
+    with pytest.raises(ConnectionRefusedError):
+        lanes.check()
+    assert lanes.committable_offsets(set(lanes.offsets)) == {}
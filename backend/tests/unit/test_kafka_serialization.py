@@ -0,0 +1,29 @@
+from app.db.kafka import (
+    VoteEvent,
+    _deserialize_key,
+    _deserialize_value,
+    _partition_by_poll_id,
+    _serialize_key,
+    _serialize_value,
+)
+
+
+def test_vote_event_roundtrip():
+    vote = VoteEvent(user_id=2**40, poll_option_id=42)
+    assert _deserialize_key(_serialize_key(1234)) == 1234
+    assert _deserialize_value(_serialize_value(vote)) == vote
+
+
+def test_legacy_json_messages_are_decodable():
+    assert _deserialize_key(b"1234") == 1234
+    assert _deserialize_value(b'{"user_id":7,"poll_option_id":42}') == VoteEvent(
+        user_id=7, poll_option_id=42
+    )
+
+
+def test_partition_does_not_depend_on_key_format():
+    partitions = list(range(12))
+    for poll_id in range(1000):
+        binary = _partition_by_poll_id(_serialize_key(poll_id), partitions, partitions)
+        legacy = _partition_by_poll_id(str(poll_id).encode(), partitions, partitions)
+        assert binary == legacy
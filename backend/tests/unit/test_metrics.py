@@ -0,0 +1,24 @@
+from app.utils.metrics import Counter, Histogram
+
+
+def test_counter_counts_per_label():
+    counter = Counter("test_events_total", "Test events", labelnames=["result"])
+    counter.inc(result="ok")
+    counter.inc(2, result="ok")
+    counter.inc(result="failed")
+
+    lines = counter.render()
+    assert 'test_events_total{result="ok"} 3' in lines
+    assert 'test_events_total{result="failed"} 1' in lines
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("test_latency_seconds", "Test latency", buckets=[0.1, 1])
+    for value in [0.05, 0.1, 0.5, 5]:
+        histogram.observe(value)
+
+    lines = histogram.render()
+    assert 'test_latency_seconds_bucket{le="0.1"} 2' in lines
+    assert 'test_latency_seconds_bucket{le="1"} 3' in lines
+    assert 'test_latency_seconds_bucket{le="+Inf"} 4' in lines
+    assert "test_latency_seconds_count 4" in lines
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+
+from argon2 import PasswordHasher
+from fastapi import HTTPException, status
+
+from app.auth.password import PasswordHashingPool
+
+
+def _pool(max_workers: int = 1, max_queued: int = 0) -> PasswordHashingPool:
+    # Cheap parameters, the tests are not about Argon2 itself
+    hasher = PasswordHasher(time_cost=1, memory_cost=1024, parallelism=1)
+    return PasswordHashingPool(hasher, max_workers=max_workers, max_queued=max_queued)
+
+
+def test_hash_and_verify():
+    async def main():
+        pool = _pool()
+        password_hash = await pool.hash("correct horse")
+        assert await pool.verify(password_hash, "correct horse")
+        assert not await pool.verify(password_hash, "battery staple")
+        assert not await pool.verify("not-a-hash", "correct horse")
+        pool.shutdown()
+
+    asyncio.run(main())
+
+
+def test_rejects_when_saturated():
+    async def main():
+        pool = _pool(max_workers=1, max_queued=1)
+        results = await asyncio.gather(
+            *(pool.hash("password") for _ in range(3)), return_exceptions=True
+        )
+        pool.shutdown()
+        return results
+
+    results = asyncio.run(main())
+    assert [isinstance(x, str) for x in results] == [True, True, False]
+    assert isinstance(results[2], HTTPException)
+    assert results[2].status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+
+
+def test_cancelled_request_counts_until_its_job_is_done():
+    async def main():
+        pool = _pool(max_workers=1, max_queued=0)
+        release = threading.Event()
+        request = asyncio.create_task(pool._run(release.wait))
+        await asyncio.sleep(0.01)
+        _ = request.cancel()
+        await asyncio.sleep(0.01)
+
+        # The job is still running, so there is still no room for another one
+        saturated = pool.pending >= pool.max_pending
+        release.set()
+        await asyncio.sleep(0.01)
+        pool.shutdown()
+        return saturated, pool.pending
+
+    assert asyncio.run(main()) == (True, 0)
@@ -0,0 +1,20 @@
+from datetime import datetime, timezone
+
+from app.db.sqlc import poll as poll_queries
+from app.utils.poll_document import PollWithUserVote, with_user_vote
+
+POLL = poll_queries.GetPollDocumentRow(
+    id=1,
+    question="Pineapple on pizza?",
+    expires_at=datetime(2030, 1, 1, tzinfo=timezone.utc),
+    creator_name="alice",
+    options=["Yes", "No"],
+    option_ids=[10, 11],
+)
+
+
+def test_user_vote_is_added_to_document():
+    document = POLL.model_dump_json().encode()
+    for user_vote in [10, None]:
+        poll = PollWithUserVote.model_validate_json(with_user_vote(document, user_vote))
+        assert poll == PollWithUserVote(**POLL.model_dump(), user_vote=user_vote)
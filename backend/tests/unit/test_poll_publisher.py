@@ -0,0 +1,40 @@
+import asyncio
+
+from app.db.sqlc import vote as vote_queries
+from app.db.valkey import PollUpdateEvent
+from app.utils.poll_publisher import PollUpdatePublisher
+
+
+class SlowValkey:
+    """Records published vote counts, taking the given time to publish each"""
+
+    def __init__(self, delays: list[float]):
+        self.delays = delays
+        self.published: list[int] = []
+
+    async def publish(self, _topic: str, message: str):
+        await asyncio.sleep(self.delays.pop(0))
+        event = PollUpdateEvent.model_validate_json(message)
+        self.published.append(event.vote_counts[0].vote_count)
+
+
+def counts(n: int) -> list[vote_queries.GetVoteCountsRow]:
+    return [vote_queries.GetVoteCountsRow(vote_option_id=1, vote_count=n)]
+
+
+def test_update_during_flush_is_published_after_it():
+    async def main():
+        # The flush of the held back update is slow
+        valkey = SlowValkey(delays=[0, 0.05, 0])
+        publisher = PollUpdatePublisher(valkey, interval=0.01)  # pyright: ignore
+        await publisher.update(1, counts(1))  # Published right away
+        await publisher.update(1, counts(2))  # Held back, flushed after the interval
+
+        # Arrives while the held back update is being published
+        await asyncio.sleep(0.02)
+        await publisher.update(1, counts(3))
+
+        await asyncio.sleep(0.1)
+        return valkey.published, publisher.pending_updates, publisher.throttled_polls
+
+    assert asyncio.run(main()) == ([1, 2, 3], {}, set())
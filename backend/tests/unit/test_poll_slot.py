@@ -0,0 +1,54 @@
+import asyncio
+
+from app.sse.manager import KEEPALIVE_FRAME, Heartbeat, PollSlot
+
+
+def test_waiting_clients_get_the_update():
+    async def main():
+        slot = PollSlot()
+        waiters = [asyncio.create_task(slot.wait_for_update(0)) for _ in range(3)]
+        await asyncio.sleep(0)
+        slot.publish(b"update")
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(main()) == [(1, b"update")] * 3
+
+
+def test_lagging_client_skips_to_latest_update():
+    async def main():
+        slot = PollSlot()
+        slot.publish(b"first")
+        slot.publish(b"second")
+        return await slot.wait_for_update(0)
+
+    assert asyncio.run(main()) == (2, b"second")
+
+
+def test_cancelled_wait_does_not_affect_others():
+    async def main():
+        slot = PollSlot()
+        cancelled = asyncio.create_task(slot.wait_for_update(0))
+        waiting = asyncio.create_task(slot.wait_for_update(0))
+        await asyncio.sleep(0)
+        _ = cancelled.cancel()
+        await asyncio.sleep(0)
+        slot.publish(b"update")
+        return await waiting
+
+    assert asyncio.run(main()) == (1, b"update")
+
+
+def test_heartbeat_sends_keepalive_to_idle_clients():
+    async def main():
+        slot = PollSlot()
+        heartbeat = Heartbeat(interval=0.01)
+        ticker = asyncio.create_task(heartbeat.run())
+        idle = await asyncio.gather(
+            *(slot.wait_for_update(0, heartbeat) for _ in range(3))
+        )
+        slot.publish(b"update")
+        updated = await slot.wait_for_update(0, heartbeat)
+        _ = ticker.cancel()
+        return idle, updated
+
+    assert asyncio.run(main()) == ([(0, KEEPALIVE_FRAME)] * 3, (1, b"update"))
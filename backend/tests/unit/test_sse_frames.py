@@ -0,0 +1,21 @@
+import json
+
+from sse_starlette import ServerSentEvent
+
+from app.db.sqlc.vote import GetVoteCountsRow
+from app.sse.manager import KEEPALIVE_FRAME, vote_update_frame
+
+
+def test_vote_update_frame_is_a_valid_sse_event():
+    vote_counts = [
+        GetVoteCountsRow(vote_option_id=1, vote_count=3),
+        GetVoteCountsRow(vote_option_id=2, vote_count=0),
+    ]
+    data = json.dumps([x.model_dump() for x in vote_counts], separators=(",", ":"))
+    event = ServerSentEvent(data=data, event="vote_update")
+
+    assert vote_update_frame(vote_counts) == event.encode()
+
+
+def test_keepalive_frame_is_a_comment():
+    assert KEEPALIVE_FRAME == ServerSentEvent(comment="keepalive").encode()
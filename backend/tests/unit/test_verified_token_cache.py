@@ -0,0 +1,28 @@
+import time
+
+from app.auth.cookie import VerifiedTokenCache
+from app.utils.user_info import UserInfo
+
+USER = UserInfo(id=1, username="alice", email="alice@example.com")
+
+
+def test_expired_tokens_are_forgotten():
+    cache = VerifiedTokenCache(max_size=10)
+    now = time.time()
+    cache.put("valid", USER, issued_at=now, expires_at=now + 60)
+    cache.put("expired", USER, issued_at=now - 60, expires_at=now - 1)
+
+    assert cache.get("valid") == (USER, now)
+    assert cache.get("expired") is None
+    assert "expired" not in cache.entries
+
+
+def test_least_recently_used_token_is_evicted():
+    cache = VerifiedTokenCache(max_size=2)
+    now = time.time()
+    for token in ["a", "b"]:
+        cache.put(token, USER, issued_at=now, expires_at=now + 60)
+    _ = cache.get("a")
+    cache.put("c", USER, issued_at=now, expires_at=now + 60)
+
+    assert list(cache.entries) == ["a", "c"]